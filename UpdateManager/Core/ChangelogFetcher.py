@@ -0,0 +1,744 @@
+# ChangelogFetcher.py
+# -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
+#
+#  Copyright (c) 2018 Canonical
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+"""
+Fetching of changelogs in the background.
+
+ConnectionPool keeps one keep-alive connection per host and thread, so
+fetching the changelogs of many packages from changelogs.ubuntu.com does
+not need a TLS handshake for every one of them.  ChangelogPrefetcher runs
+the fetches in a few worker threads, in the order of their priority, and
+ChangelogCache keeps the results on disk, as the changelog of a given
+source version does not change.  ChangelogMirrors has the locations that
+the changelogs are fetched from and keeps track of the ones that fail.
+ChangelogStore keeps the changelogs that are shown compressed in memory.
+"""
+
+from __future__ import absolute_import
+
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
+import atexit
+import errno
+import fcntl
+import hashlib
+import itertools
+import json
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.error import HTTPError
+    from urllib.parse import quote, urljoin, urlsplit
+    from urllib.request import getproxies, proxy_bypass, Request, urlopen
+except ImportError:
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib import getproxies, proxy_bypass, quote
+    from urllib2 import HTTPError, Request, urlopen
+    from urlparse import urljoin, urlsplit
+
+import apt_pkg
+
+from UpdateManager.Core.utils import get_cache_dir
+
+# statuses that are followed to their Location
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+# unread responses up to this size are read to keep the connection
+DRAIN_SIZE = 16 * 1024
+
+
+class PooledResponse(object):
+    """ A response of a pooled connection, the connection is only used
+        again if the response was read completely before it is closed
+    """
+
+    def __init__(self, pool, key, response):
+        self._pool = pool
+        self._key = key
+        self._response = response
+        self.headers = response.msg
+
+    def read(self, *args):
+        return self._response.read(*args)
+
+    def read1(self, *args):
+        return self._response.read1(*args)
+
+    def readline(self, *args):
+        return self._response.readline(*args)
+
+    def info(self):
+        return self.headers
+
+    def close(self):
+        length = self._response.length
+        if length is not None and length <= DRAIN_SIZE:
+            # reading a small rest is cheaper than a new connection (and
+            # readline() does not notice the end of the body)
+            self._response.read()
+        if not self._response.isclosed():
+            # unread data is left on the connection, don't reuse it
+            self._pool.drop(self._key)
+        self._response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ConnectionPool(object):
+    """ Keep-alive HTTP(S) connections, one per host for every thread
+        that uses the pool
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _get_connections(self):
+        if not hasattr(self._local, "connections"):
+            self._local.connections = {}
+        return self._local.connections
+
+    def _use_urlopen(self, res):
+        """ Return True if the uri needs to go through urlopen(), as it
+            is no http(s) uri, has credentials or is proxied
+        """
+        if res.scheme not in ("http", "https") or res.username:
+            return True
+        if res.scheme == "http" and apt_pkg.config.find(
+                "Acquire::http::Proxy"):
+            # see utils.init_proxy()
+            return True
+        return (res.scheme in getproxies() and
+                not proxy_bypass(res.hostname))
+
+    def _get_connection(self, key):
+        connections = self._get_connections()
+        conn = connections.get(key)
+        if conn is None:
+            (scheme, host, port) = key
+            if scheme == "https":
+                conn_class = HTTPSConnection
+            else:
+                conn_class = HTTPConnection
+            if self.timeout is None:
+                conn = conn_class(host, port)
+            else:
+                conn = conn_class(host, port, timeout=self.timeout)
+            connections[key] = conn
+        return conn
+
+    def drop(self, key):
+        " close the connection of the current thread to the given host "
+        conn = self._get_connections().pop(key, None)
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        " close all connections of the current thread "
+        for key in list(self._get_connections()):
+            self.drop(key)
+
+    def _request(self, key, path, headers):
+        conn = self._get_connection(key)
+        reused = conn.sock is not None
+        try:
+            conn.request("GET", path, headers=headers)
+            return conn.getresponse()
+        except (HTTPException, socket.error):
+            self.drop(key)
+            if not reused:
+                raise
+        # the server closed the idle connection, try again with a new one
+        conn = self._get_connection(key)
+        try:
+            conn.request("GET", path, headers=headers)
+            return conn.getresponse()
+        except (HTTPException, socket.error):
+            self.drop(key)
+            raise
+
+    def urlopen(self, uri, headers=None):
+        """ Return a response for the given uri with read(), readline()
+            and close(), like urlopen() does.  HTTPError is raised for
+            error statuses.
+        """
+        for redirect in range(MAX_REDIRECTS + 1):
+            res = urlsplit(uri)
+            if self._use_urlopen(res):
+                return urlopen(Request(uri, headers=headers or {}))
+            key = (res.scheme, res.hostname, res.port)
+            path = res.path or "/"
+            if res.query:
+                path += "?" + res.query
+            response = self._request(key, path, headers or {})
+            if response.status < 300:
+                return PooledResponse(self, key, response)
+            # error and redirect bodies are small, read them to keep the
+            # connection usable
+            body = response.read()
+            if response.will_close:
+                self.drop(key)
+            location = response.getheader("Location")
+            if response.status in REDIRECT_STATUSES and location:
+                uri = urljoin(uri, location)
+                continue
+            logging.debug("%s returned %s (%s bytes)" % (
+                uri, response.status, len(body)))
+            raise HTTPError(uri, response.status, response.reason,
+                            response.msg, None)
+        raise HTTPError(uri, response.status, "Too many redirects",
+                        response.msg, None)
+
+
+class ChangelogPrefetcher(object):
+    """ Call fetch(name) for the queued package names in a few worker
+        threads, the ones with the lowest priority first.  Package names
+        that were done already are not fetched again, unless fetch
+        returned False (e.g. because the network is down), then they are
+        fetched again the next time they are queued.
+    """
+
+    # priorities of the queued package names
+    PRIORITY_NOW = 0
+    PRIORITY_PREFETCH = 1
+
+    def __init__(self, fetch, threads=4):
+        self._fetch = fetch
+        self.threads = max(threads, 1)
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        # name -> (priority, seq) of the queued entry that counts
+        self._pending = {}
+        # name -> Event that is set once fetch(name) returned
+        self._events = {}
+        self._workers = []
+
+    def _start_workers(self):
+        while len(self._workers) < self.threads:
+            worker = threading.Thread(target=self._run)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _queue_name(self, name, priority):
+        """ Queue the name (if it is not done yet) and return the Event
+            that is set when it is done
+        """
+        event = self._events.get(name)
+        if event is None:
+            event = self._events[name] = threading.Event()
+        elif name not in self._pending:
+            # done or being fetched
+            return event
+        elif self._pending[name][0] <= priority:
+            return event
+        # an entry with a lower priority may be in the queue already, it
+        # is skipped when it comes up
+        entry = (priority, next(self._counter))
+        self._pending[name] = entry
+        self._queue.put(entry + (name,))
+        return event
+
+    def prefetch(self, names):
+        " queue the names to be fetched in the given order "
+        with self._lock:
+            for name in names:
+                self._queue_name(name, self.PRIORITY_PREFETCH)
+            self._start_workers()
+
+    def fetch(self, name):
+        """ Queue the name in front of the prefetched ones and return an
+            Event that is set when it is done
+        """
+        with self._lock:
+            event = self._queue_name(name, self.PRIORITY_NOW)
+            self._start_workers()
+        return event
+
+    def is_done(self, name):
+        event = self._events.get(name)
+        return event is not None and event.is_set()
+
+    def clear(self):
+        """ Forget about the queued names and the ones that are done.  The
+            events of the ones that are not done are set, so the callers
+            that wait for them need to check whether they got a result.
+        """
+        with self._lock:
+            events = self._events
+            self._pending = {}
+            self._events = {}
+        for event in events.values():
+            event.set()
+
+    def _run(self):
+        while True:
+            (priority, seq, name) = self._queue.get()
+            with self._lock:
+                if self._pending.get(name) != (priority, seq):
+                    # done already, requeued or cleared
+                    continue
+                del self._pending[name]
+                event = self._events[name]
+            done = True
+            try:
+                done = self._fetch(name) is not False
+            except Exception:
+                logging.exception("error fetching the changelog of %s" %
+                                  name)
+            if not done:
+                with self._lock:
+                    if self._events.get(name) is event:
+                        del self._events[name]
+            event.set()
+
+
+class ChangelogMirrors(object):
+    """ The locations (bases) that the changelogs are fetched from, in the
+        order they are tried, e.g. a site-local mirror or caching proxy
+        before changelogs.ubuntu.com.
+
+        They are read from the Update-Manager::Changelogs-URIs list in the
+        apt config or else from URIS (separated by whitespace) in the
+        CHANGELOGS section of /etc/update-manager/changelogs.  A base that
+        failed is not tried for retry_interval seconds, unless all the
+        others failed too, so a dead mirror does not delay every package.
+    """
+
+    CONF = "/etc/update-manager/changelogs"
+    URIS_KEY = "Update-Manager::Changelogs-URIs"
+    RETRY_INTERVAL_KEY = "Update-Manager::Changelogs-Retry-Interval"
+    RETRY_INTERVAL = 5 * 60
+
+    def __init__(self, default_bases, bases=None, retry_interval=None):
+        if bases is None:
+            bases = self._read_bases()
+        # the paths are appended to the bases
+        self.bases = [base.rstrip("/") + "/"
+                      for base in bases or default_bases]
+        if retry_interval is None:
+            retry_interval = apt_pkg.config.find_i(self.RETRY_INTERVAL_KEY,
+                                                   self.RETRY_INTERVAL)
+        self.retry_interval = retry_interval
+        # base -> time of its last failure
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def _read_bases(self):
+        bases = apt_pkg.config.value_list(self.URIS_KEY)
+        if not bases and os.path.exists(self.CONF):
+            parser = configparser.ConfigParser()
+            try:
+                parser.read(self.CONF)
+            except configparser.Error as e:
+                logging.warning("failed to read '%s': %s" % (self.CONF, e))
+            else:
+                if parser.has_option("CHANGELOGS", "URIS"):
+                    bases = parser.get("CHANGELOGS", "URIS").split()
+        usable = []
+        for base in bases:
+            # see MyCache.HttpsChangelogsUnsupportedError
+            res = urlsplit(base)
+            if res.scheme == "https" and res.username:
+                logging.warning("ignoring the changelogs location %s, https "
+                                "with username/password is not supported" %
+                                base)
+                continue
+            usable.append(base)
+        return usable
+
+    def get_bases(self):
+        """ Return the bases to try, in order.  The ones that failed
+            recently are left out, unless all of them did.
+        """
+        now = time.time()
+        with self._lock:
+            failed = dict((base, when)
+                          for (base, when) in self._failures.items()
+                          if now - when < self.retry_interval)
+        bases = [base for base in self.bases if base not in failed]
+        if not bases:
+            # the one that failed first may be back first
+            bases = sorted(failed, key=failed.get)
+        return bases
+
+    def failed(self, base):
+        " the base could not be reached or had a server error "
+        with self._lock:
+            self._failures[base] = time.time()
+
+    def succeeded(self, base):
+        with self._lock:
+            self._failures.pop(base, None)
+
+
+class ChangelogCache(object):
+    """ Changelogs and NEWS.Debian files on disk, by source package,
+        source version and file name (or uri, for the ones that are not
+        on changelogs.ubuntu.com).
+
+        The system-wide directory is used if it is writable, otherwise
+        the one in the cache directory of the user.  Entries are written
+        atomically and the least recently used ones are removed when the
+        directory grows above max_size.  Files that are missing on the
+        server are remembered for negative_ttl seconds.
+    """
+
+    SYSTEM_DIR_KEY = "Update-Manager::Changelog-Cache-Dir"
+    SYSTEM_DIR = "/var/cache/update-manager/changelogs"
+    MAX_SIZE_KEY = "Update-Manager::Changelog-Cache-Size"
+    MAX_SIZE = 20 * 1024 * 1024
+    NEGATIVE_TTL_KEY = "Update-Manager::Changelog-Cache-Negative-TTL"
+    NEGATIVE_TTL = 60 * 60
+    LOCK_FILE = "lock"
+
+    def __init__(self, cache_dir=None, max_size=None, negative_ttl=None):
+        # looked up when it is used first
+        self._cache_dir = cache_dir
+        if max_size is None:
+            max_size = apt_pkg.config.find_i(self.MAX_SIZE_KEY,
+                                             self.MAX_SIZE)
+        self.max_size = max_size
+        if negative_ttl is None:
+            negative_ttl = apt_pkg.config.find_i(self.NEGATIVE_TTL_KEY,
+                                                 self.NEGATIVE_TTL)
+        self.negative_ttl = negative_ttl
+        # estimate of the size of the directory, see _evict()
+        self._size = None
+        self._lock = threading.Lock()
+
+    @property
+    def cache_dir(self):
+        if self._cache_dir is None:
+            self._cache_dir = self._get_cache_dir()
+        return self._cache_dir
+
+    def _get_cache_dir(self):
+        system_dir = apt_pkg.config.find(self.SYSTEM_DIR_KEY,
+                                         self.SYSTEM_DIR)
+        try:
+            if not os.path.isdir(system_dir):
+                os.makedirs(system_dir, 0o755)
+            if os.access(system_dir, os.W_OK):
+                return system_dir
+        except OSError:
+            pass
+        return os.path.join(get_cache_dir(), "changelogs")
+
+    def _get_path(self, source, version, name):
+        if "/" in name:
+            name = hashlib.sha1(name.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, "%s_%s_%s" % (
+            source, quote(version, safe=""), name))
+
+    def get(self, source, version, name):
+        """ Return (text, truncated) of the entry, text is None if the
+            file is missing on the server.  Return None if there is no
+            (current) entry.
+        """
+        path = self._get_path(source, version, name)
+        try:
+            with open(path, "rb") as f:
+                header = json.loads(f.readline().decode("utf-8"))
+                text = f.read().decode("utf-8")
+        except (IOError, OSError, ValueError):
+            return None
+        if header.get("missing"):
+            if time.time() - header.get("time", 0) > self.negative_ttl:
+                return None
+            return (None, False)
+        try:
+            # used recently, see _evict()
+            os.utime(path, None)
+        except OSError:
+            pass
+        return (text, header.get("truncated", False))
+
+    def put(self, source, version, name, text, truncated=False):
+        """ Store the text, truncated tells that only the beginning of
+            the file is in there
+        """
+        self._write(self._get_path(source, version, name),
+                    {"truncated": truncated}, text)
+
+    def put_missing(self, source, version, name):
+        " remember that the file is missing on the server "
+        self._write(self._get_path(source, version, name),
+                    {"missing": True, "time": time.time()}, "")
+
+    def _open_lock(self):
+        """ Return the locked file that serializes the writing and the
+            eviction of several processes
+        """
+        lock_file = open(os.path.join(self.cache_dir, self.LOCK_FILE), "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        except Exception:
+            lock_file.close()
+            raise
+        return lock_file
+
+    def _write(self, path, header, text):
+        content = (json.dumps(header) + "\n" + text).encode("utf-8")
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir, 0o755)
+            with self._lock, self._open_lock():
+                # a temp file that is renamed, readers never see a
+                # partial entry
+                fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir,
+                                                prefix=".tmp")
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        f.write(content)
+                    os.chmod(tmp_path, 0o644)
+                    os.rename(tmp_path, path)
+                except Exception:
+                    os.unlink(tmp_path)
+                    raise
+                if self._size is not None:
+                    self._size += len(content)
+                self._evict()
+        except (IOError, OSError) as e:
+            logging.warning("could not write changelog cache file '%s': %s"
+                            % (path, e))
+
+    def _get_entries(self):
+        " return (mtime, size, path) of the entries, oldest first "
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if filename == self.LOCK_FILE or filename.startswith(".tmp"):
+                continue
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                st = os.stat(path)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    # evicted by another process
+                    continue
+                raise
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        return entries
+
+    def _evict(self):
+        """ Remove the least recently used entries if the directory is
+            larger than max_size, down to 3/4 of it.  The directory is
+            only listed if the size that this process knows of exceeds
+            max_size.
+        """
+        if self._size is not None and self._size <= self.max_size:
+            return
+        entries = self._get_entries()
+        self._size = sum(size for (mtime, size, path) in entries)
+        if self._size <= self.max_size:
+            return
+        for (mtime, size, path) in entries:
+            if self._size <= self.max_size * 3 // 4:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            self._size -= size
+
+
+class ChangelogStore(object):
+    """ A dict like store for the texts that are shown for the packages,
+        e.g. MyCache.all_changes.  The texts are kept compressed in
+        memory, up to max_size bytes.  The least recently used ones are
+        moved to a private temporary directory in spill_dir then (the
+        default temporary directory if None) and read back from there
+        when they are used again.  The directory is removed when the store
+        is cleared and at exit.
+
+        size and raw_size are the compressed and the original size of the
+        texts in memory, hits, misses, spills and loads count the lookups
+        and the moves to and from the disk, see get_stats().
+    """
+
+    MAX_SIZE_KEY = "Update-Manager::Changelog-Memory-Size"
+    MAX_SIZE = 2 * 1024 * 1024
+
+    def __init__(self, label="changes", max_size=None, spill_dir=None):
+        self.label = label
+        if max_size is None:
+            max_size = apt_pkg.config.find_i(self.MAX_SIZE_KEY,
+                                             self.MAX_SIZE)
+        self.max_size = max_size
+        self.spill_dir = spill_dir
+        # the private directory of the texts on disk, created on the first
+        # spill
+        self._dir = None
+        # key -> (compressed text, length of the text), least recently
+        # used first
+        self._data = OrderedDict()
+        # key -> length of the text, for the ones on disk
+        self._spilled = {}
+        self._lock = threading.Lock()
+        self.size = 0
+        self.raw_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.spills = 0
+        self.loads = 0
+
+    def __len__(self):
+        return len(self._data) + len(self._spilled)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._data) + list(self._spilled))
+
+    def keys(self):
+        return list(self)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data or key in self._spilled
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                (data, length) = self._data.pop(key)
+                self._data[key] = (data, length)
+                return zlib.decompress(data).decode("utf-8")
+            value = self._load(key) if key in self._spilled else None
+            if value is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key not in self._data and key not in self._spilled:
+                raise KeyError(key)
+            self._remove(key)
+
+    def clear(self):
+        """ drop all entries, the counters are kept """
+        with self._lock:
+            for key in list(self._data) + list(self._spilled):
+                self._remove(key)
+            if self._dir is not None:
+                shutil.rmtree(self._dir, True)
+                self._dir = None
+
+    def get_stats(self):
+        " return the sizes and the counters, for debugging "
+        with self._lock:
+            return {"entries": len(self._data),
+                    "spilled": len(self._spilled),
+                    "size": self.size,
+                    "raw_size": self.raw_size,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "spills": self.spills,
+                    "loads": self.loads}
+
+    def _get_path(self, key):
+        if self._dir is None:
+            self._dir = tempfile.mkdtemp(
+                prefix="update-manager-%s-" % self.label, dir=self.spill_dir)
+            atexit.register(shutil.rmtree, self._dir, True)
+        return os.path.join(self._dir,
+                            hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def _load(self, key):
+        " return the text of the key from the disk, None if it is gone "
+        length = self._spilled.pop(key)
+        try:
+            with open(self._get_path(key), "rb") as f:
+                data = f.read()
+            os.unlink(self._get_path(key))
+        except (IOError, OSError) as e:
+            logging.warning("can't read the spilled %s of %s: %s" % (
+                self.label, key, e))
+            return None
+        self.loads += 1
+        self._insert(key, data, length)
+        return zlib.decompress(data).decode("utf-8")
+
+    def _set(self, key, value):
+        self._remove(key)
+        self._insert(key, zlib.compress(value.encode("utf-8")), len(value))
+
+    def _insert(self, key, data, length):
+        self._data[key] = (data, length)
+        self.size += len(data)
+        self.raw_size += length
+        # the newest one is kept, even if it is larger than max_size
+        while self.size > self.max_size and len(self._data) > 1:
+            (old_key, (old_data, old_length)) = self._data.popitem(
+                last=False)
+            self.size -= len(old_data)
+            self.raw_size -= old_length
+            try:
+                with open(self._get_path(old_key), "wb") as f:
+                    f.write(old_data)
+            except (IOError, OSError) as e:
+                logging.warning("can't spill the %s of %s: %s" % (
+                    self.label, old_key, e))
+                continue
+            self._spilled[old_key] = old_length
+            self.spills += 1
+
+    def _remove(self, key):
+        if key in self._data:
+            (data, length) = self._data.pop(key)
+            self.size -= len(data)
+            self.raw_size -= length
+        elif key in self._spilled:
+            del self._spilled[key]
+            try:
+                os.unlink(self._get_path(key))
+            except OSError:
+                pass
@@ -0,0 +1,234 @@
+# DebArchive.py
+# -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
+#
+#  Copyright (c) 2018 Canonical
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+"""
+Reading of single files from .deb archives.
+
+A .deb is an ar archive whose data.tar member (usually compressed) has the
+files of the package.  The data.tar is read as a stream, so it is only
+decompressed up to the files in question and nothing is unpacked to disk.
+
+tarfile only knows zstd since Python 3.14, before that a data.tar.zst is
+decompressed with the zstandard module or, if it is not installed, with
+the zstd command.
+"""
+
+from __future__ import absolute_import
+
+import os
+import subprocess
+import tarfile
+import threading
+
+try:
+    import zstandard
+    ZSTD_ERRORS = zstandard.ZstdError
+except ImportError:
+    zstandard = None
+    ZSTD_ERRORS = ()
+
+AR_MAGIC = b"!<arch>\n"
+AR_HEADER_SIZE = 60
+AR_HEADER_END = b"`\n"
+DATA_TAR = "data.tar"
+# the compression of data.tar -> the tarfile stream mode
+DATA_TAR_MODES = {
+    "": "r|",
+    ".gz": "r|gz",
+    ".bz2": "r|bz2",
+    ".xz": "r|xz",
+}
+DATA_TAR_ZSTD = ".zst"
+ZSTD = "/usr/bin/zstd"
+CHUNK_SIZE = 64 * 1024
+
+
+class DebArchiveError(Exception):
+    """ the deb can't be read """
+    pass
+
+
+class ArMember(object):
+    """ file object for a member of an ar archive, it ends where the
+        member ends
+    """
+
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+class ZstdPipe(object):
+    """ file object for the output of the zstd command that decompresses
+        fileobj, which is fed to it by a thread
+    """
+
+    def __init__(self, fileobj):
+        self.proc = subprocess.Popen([ZSTD, "-d", "-c", "-q"],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+        self.feeder = threading.Thread(target=self._feed, args=(fileobj,))
+        self.feeder.daemon = True
+        self.feeder.start()
+
+    def _feed(self, fileobj):
+        try:
+            while True:
+                data = fileobj.read(CHUNK_SIZE)
+                if not data:
+                    break
+                self.proc.stdin.write(data)
+        except (IOError, OSError, ValueError):
+            # closed early, see close()
+            pass
+        finally:
+            try:
+                self.proc.stdin.close()
+            except (IOError, OSError):
+                pass
+
+    def read(self, size=-1):
+        return self.proc.stdout.read(size)
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.stdout.close()
+        self.proc.wait()
+        self.feeder.join()
+        self.proc.stderr.close()
+
+
+def _open_zstd(fileobj):
+    """ Return a (file object, tarfile stream mode) for the zstd
+        compressed tar in fileobj, the file object needs to be closed
+    """
+    if "zst" in tarfile.TarFile.OPEN_METH:
+        return (fileobj, "r|zst")
+    if zstandard is not None:
+        return (zstandard.ZstdDecompressor().stream_reader(fileobj), "r|")
+    if os.path.exists(ZSTD):
+        return (ZstdPipe(fileobj), "r|")
+    raise DebArchiveError("no support for zstd, install python3-zstandard "
+                          "or zstd")
+
+
+def iter_ar_members(fileobj):
+    """ Yield the (name, file object) of the members of the ar archive in
+        fileobj, which needs to be seekable.  The file object of a member
+        can only be read until the next one is yielded.
+    """
+    if fileobj.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise DebArchiveError("not an ar archive")
+    while True:
+        header = fileobj.read(AR_HEADER_SIZE)
+        if not header:
+            return
+        if (len(header) != AR_HEADER_SIZE or
+                header[-len(AR_HEADER_END):] != AR_HEADER_END):
+            raise DebArchiveError("broken ar member header")
+        # GNU ar ends the names with a slash
+        name = header[:16].decode("ascii", "replace").rstrip().rstrip("/")
+        try:
+            size = int(header[48:58])
+        except ValueError:
+            raise DebArchiveError("broken size of ar member %s" % name)
+        member = ArMember(fileobj, size)
+        yield (name, member)
+        # skip the rest, the members are aligned to two bytes
+        fileobj.seek(member.remaining + size % 2, os.SEEK_CUR)
+
+
+def _strip_path(name):
+    " the paths in data.tar usually start with ./ "
+    if name.startswith("./"):
+        name = name[2:]
+    return name.lstrip("/")
+
+
+def _dirname(name):
+    " the directory of the path, with a trailing slash "
+    return name.rpartition("/")[0] + "/"
+
+
+def read_files(path, names):
+    """ Return a dict that maps those of the paths in names (relative to
+        the root, e.g. "usr/share/doc/apt/changelog.gz") that are regular
+        files in the deb at path to their content.  An entry of names can
+        also be a tuple of alternatives, only the first of them that is in
+        the data.tar is read.  The data.tar is only read until all of them
+        are found, or until it left the directories of the missing ones:
+        dpkg-deb writes it by walking the tree, so the entries of a
+        directory come one after the other.
+    """
+    groups = [(name,) if isinstance(name, str) else tuple(name)
+              for name in names]
+    found = {}
+    with open(path, "rb") as deb:
+        for (name, member) in iter_ar_members(deb):
+            if not name.startswith(DATA_TAR):
+                continue
+            compression = name[len(DATA_TAR):]
+            if compression == DATA_TAR_ZSTD:
+                (member, mode) = _open_zstd(member)
+            else:
+                mode = DATA_TAR_MODES.get(compression)
+            if mode is None:
+                raise DebArchiveError("unsupported member %s" % name)
+            try:
+                tar = tarfile.open(fileobj=member, mode=mode)
+                # the directories of the wanted paths that were entered
+                entered = set()
+                for tarinfo in tar:
+                    filename = _strip_path(tarinfo.name)
+                    for group in list(groups):
+                        # symlinks to the files of other packages are
+                        # not followed
+                        if filename in group and tarinfo.isfile():
+                            found[filename] = tar.extractfile(tarinfo).read()
+                            groups.remove(group)
+                            continue
+                        directories = set(_dirname(wanted)
+                                          for wanted in group)
+                        for directory in directories:
+                            if filename.startswith(directory):
+                                entered.add(directory)
+                        if all(directory in entered and
+                               not filename.startswith(directory)
+                               for directory in directories):
+                            # left behind, the missing ones are not there
+                            groups.remove(group)
+                    if not groups:
+                        break
+            except (tarfile.TarError, EOFError, ZSTD_ERRORS) as e:
+                raise DebArchiveError("can't read %s: %s" % (name, e))
+            finally:
+                if hasattr(member, "close"):
+                    member.close()
+            return found
+    raise DebArchiveError("no %s member" % DATA_TAR)
@@ -46,8 +46,8 @@ try:
 except ImportError:
     from urllib2 import HTTPError, Request, URLError, urlopen, quote
 
-from .utils import (get_lang, get_dist, get_dist_version, get_ubuntu_flavor,
-                    get_ubuntu_flavor_name)
+from .utils import (decode_response, get_lang, get_dist, get_dist_version,
+                    get_ubuntu_flavor, get_ubuntu_flavor_name)
 
 
 class MetaReleaseParseError(Exception):
@@ -330,6 +330,10 @@ class MetaReleaseCore(object):
         if lastmodified > 0 and not self.forceDownload:
             req.add_header("If-Modified-Since",
                            time.asctime(time.gmtime(lastmodified)))
+            etag = self._read_etag()
+            if etag:
+                req.add_header("If-None-Match", etag)
+        req.add_header("Accept-Encoding", "gzip")
         try:
             # open
             uri = urlopen(req, timeout=20)
@@ -346,11 +350,13 @@ class MetaReleaseCore(object):
             # we may get exception here on e.g. disk full
             try:
                 f = open(self.METARELEASE_FILE, "w+")
-                for line in uri.readlines():
+                body = decode_response(uri)
+                for line in iter(body.readline, b""):
                     f.write(line.decode("UTF-8"))
                 f.flush()
                 f.seek(0, 0)
                 self.metarelease_information = f
+                self._write_etag(uri.info().get("ETag"))
             except IOError as e:
                 pass
             uri.close()
@@ -386,6 +392,27 @@ class MetaReleaseCore(object):
             self._debug("NO self.metarelease_information")
         self.downloaded.set()
 
+    def _get_etag_file(self):
+        " the ETag of the meta-release file is kept next to it "
+        return self.METARELEASE_FILE + ".etag"
+
+    def _read_etag(self):
+        try:
+            with open(self._get_etag_file()) as f:
+                return f.read().strip()
+        except IOError:
+            return None
+
+    def _write_etag(self, etag):
+        try:
+            if etag:
+                with open(self._get_etag_file(), "w") as f:
+                    f.write(etag)
+            elif os.path.exists(self._get_etag_file()):
+                os.unlink(self._get_etag_file())
+        except (IOError, OSError) as e:
+            self._debug("can't write '%s' (%s)" % (self._get_etag_file(), e))
+
     @property
     def downloading(self):
         return not self.downloaded.is_set()
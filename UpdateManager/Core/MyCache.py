@@ -26,14 +26,16 @@ import warnings
 warnings.filterwarnings("ignore", "apt API not stable yet", FutureWarning)
 import apt
 import apt_pkg
+from concurrent.futures import Future
+import itertools
 import logging
 import os
 try:
     from urllib.error import HTTPError
-    from urllib.request import urlopen
-    from urllib.parse import urlsplit
+    from urllib.parse import unquote, urlsplit
 except ImportError:
-    from urllib2 import HTTPError, urlopen
+    from urllib import unquote
+    from urllib2 import HTTPError
     from urlparse import urlsplit
 try:
     from http.client import BadStatusLine
@@ -42,8 +44,20 @@ except ImportError:
 import socket
 import subprocess
 import re
+import threading
+import time
+import zlib
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import DistUpgrade.DistUpgradeCache
 from gettext import gettext as _
+from UpdateManager.Core.ChangelogFetcher import (
+    ChangelogCache, ChangelogMirrors, ChangelogPrefetcher, ChangelogStore,
+    ConnectionPool)
+from UpdateManager.Core import DebArchive
+from UpdateManager.Core.utils import decode_response, get_dist, LRUCache
 try:
     from launchpadlib.launchpad import Launchpad
 except ImportError:
@@ -51,7 +65,10 @@ except ImportError:
 
 SYNAPTIC_PINFILE = "/var/lib/synaptic/preferences"
 CHANGELOGS_POOL = "https://changelogs.ubuntu.com/changelogs/pool/"
-CHANGELOGS_URI = CHANGELOGS_POOL + "%s/%s/%s/%s_%s/%s"
+CHANGELOGS_PATH = "%s/%s/%s/%s_%s/%s"
+CHANGELOGS_URI = CHANGELOGS_POOL + CHANGELOGS_PATH
+# the version in the header line of a changelog stanza, after the name
+CHANGELOG_VERSION_RE = re.compile(r"\((.*)\)(.*)$")
 
 
 class HttpsChangelogsUnsupportedError(Exception):
@@ -62,9 +79,41 @@ class HttpsChangelogsUnsupportedError(Exception):
     pass
 
 
+class ChangelogCancelledError(Exception):
+    """ the download of a changelog is not needed anymore """
+    pass
+
+
 class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
 
     CHANGELOG_ORIGIN = "Ubuntu"
+    # number of candidates whose dependencies are kept in dependency_cache
+    DEPENDENCY_CACHE_SIZE = 20000
+    # if set, get_required_download() is checked against required_download
+    VERIFY_DOWNLOAD_SIZE_KEY = "Update-Manager::Verify-Download-Size"
+    # the changelogs of the updates are fetched in the background by
+    # prefetch_changelogs() with this many threads
+    PREFETCH_CHANGELOGS_KEY = "Update-Manager::Prefetch-Changelogs"
+    CHANGELOG_PREFETCH_THREADS = 4
+    CHANGELOG_PREFETCH_THREADS_KEY = \
+        "Update-Manager::Changelog-Prefetch-Threads"
+    # seconds between the updates of partial_changes
+    PARTIAL_CHANGES_INTERVAL = 0.1
+    # the changelog uris of the PPA sources are kept in changelog_cache
+    # under this name, with the reference of the PPA
+    PPA_CHANGELOG_URI_NAME = "launchpad:%s"
+    # the published sources of a PPA that are read at most to find the
+    # ones of several updates at once, two of the batches of launchpadlib;
+    # the others are queried one by one
+    PPA_SOURCES_LIMIT = 150
+    # the changelog and NEWS.Debian are read from the debs that are in
+    # Dir::Cache::archives already, from the first of these files in
+    # /usr/share/doc/<package>/ that is there
+    LOCAL_CHANGELOGS_KEY = "Update-Manager::Local-Changelogs"
+    LOCAL_CHANGELOG_FILES = {
+        "changelog": ("changelog.Debian.gz", "changelog.gz"),
+        "NEWS.Debian": ("NEWS.Debian.gz",),
+    }
 
     def __init__(self, progress, rootdir=None):
         apt.Cache.__init__(self, progress, rootdir)
@@ -77,14 +126,48 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
         assert(not self._dpkgJournalDirty())
         # init the regular cache
         self._initDepCache()
-        self.all_changes = {}
-        self.all_news = {}
+        # the beginning of the changelogs that are being downloaded
+        self.partial_changes = {}
+        # the texts for the changelogs that failed to download because of
+        # the network, they are not in all_changes and fetched again
+        self.failed_changes = {}
+        # (source, version, file name or uri) -> Future of the download
+        self._changelog_downloads = {}
+        self._changelog_downloads_lock = threading.Lock()
+        # the base uri of third-party archives -> the time at which none
+        # of the changelogs were there, see _get_third_party_changelog()
+        self._changelogs_unsupported = {}
+        # keep-alive connections for the changelog downloads
+        self.connection_pool = ConnectionPool()
+        self.changelog_cache = ChangelogCache()
+        # the texts that are shown for the packages, compressed and moved
+        # to a temporary directory if they exceed their memory budget
+        self.all_changes = ChangelogStore("changes")
+        self.all_news = ChangelogStore("news")
+        # the changelogs are fetched from a local mirror, if configured
+        self.changelog_mirrors = ChangelogMirrors([CHANGELOGS_POOL])
+        self.changelog_prefetcher = ChangelogPrefetcher(
+            self._fetch_news_and_changelog,
+            apt_pkg.config.find_i(self.CHANGELOG_PREFETCH_THREADS_KEY,
+                                  self.CHANGELOG_PREFETCH_THREADS))
+        # the debs in Dir::Cache::archives, see _get_archives
+        self._archives = None
+        self._archive_paths = {}
+        self._archives_stamp = None
         # on broken packages, try to fix via saveDistUpgrade()
         if self._depcache.broken_count > 0:
             self.saveDistUpgrade()
         assert (self._depcache.broken_count == 0 and
                 self._depcache.del_count == 0)
         self.launchpad = None
+        # launchpadlib is not thread-safe
+        self._launchpad_lock = threading.Lock()
+        # PPA reference -> its archive, and -> (source name, version) ->
+        # its published sources, see _resolve_ppa_changelog_uri()
+        self._ppa_archives = {}
+        self._ppa_sources = {}
+        # the Launchpad distro series that is running, False if unknown
+        self._launchpad_series = None
         # generate versioned_kernel_pkgs_regexp for later use
         apt_versioned_kernel_pkgs = apt_pkg.config.value_list(
             "APT::VersionedKernelPackages")
@@ -101,6 +184,27 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
             self.versioned_kernel_pkgs_regexp = None
             self.running_kernel_pkgs_regexp = None
 
+    def open(self, progress=None):
+        # apt.Cache.__init__() opens the cache, so this may run before
+        # our __init__()
+        if getattr(self, "dependency_cache", None) is None:
+            # (package id, candidate version id) -> dependencies, see
+            # UpdateList.DependencyClosures
+            self.dependency_cache = LRUCache(self.DEPENDENCY_CACHE_SIZE)
+        else:
+            self.dependency_cache.clear()
+        # name -> details of the candidate, see _get_changelog_info(), only
+        # this thread may add to it
+        self._changelog_info = {}
+        self._apt_thread = threading.current_thread()
+        # name -> the files of _get_local_changelogs()
+        self._local_changelogs = {}
+        if getattr(self, "changelog_prefetcher", None) is not None:
+            # the jobs that already run give up when they miss the
+            # details of their package
+            self.changelog_prefetcher.clear()
+        super(MyCache, self).open(progress)
+
     def _dpkgJournalDirty(self):
         """
         test if the dpkg journal is dirty
@@ -121,6 +225,8 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
         if os.path.exists(SYNAPTIC_PINFILE):
             self._depcache.read_pinfile(SYNAPTIC_PINFILE)
         self._depcache.init()
+        # the candidates may have changed
+        self.dependency_cache.clear()
 
     def clear(self):
         self._initDepCache()
@@ -133,6 +239,91 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
         pm.get_archives(fetcher, self._list, self._records)
         return fetcher.fetch_needed
 
+    def _get_archives(self):
+        """ Return a dict that maps the (name, version, architecture) of
+            the debs in Dir::Cache::archives to their size, and
+            _archive_paths to their path.  It is only read again if the
+            directory changes.
+        """
+        archives_dir = apt_pkg.config.find_dir("Dir::Cache::archives")
+        try:
+            stamp = (archives_dir, os.stat(archives_dir).st_mtime)
+        except OSError:
+            stamp = (archives_dir, None)
+        if self._archives is not None and stamp == self._archives_stamp:
+            return self._archives
+
+        self._archives = {}
+        self._archive_paths = {}
+        self._archives_stamp = stamp
+        try:
+            filenames = os.listdir(archives_dir)
+        except OSError:
+            filenames = []
+        for filename in filenames:
+            # name_version_arch.deb, the parts are %-quoted by apt
+            if not filename.endswith(".deb"):
+                continue
+            parts = filename[:-len(".deb")].split("_")
+            if len(parts) != 3:
+                continue
+            path = os.path.join(archives_dir, filename)
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                continue
+            key = tuple(unquote(part) for part in parts)
+            self._archives[key] = size
+            self._archive_paths[key] = path
+        return self._archives
+
+    def _get_archived_size(self, rawpkg, ver):
+        """ Return the size of ver if it is in the archives already """
+        size = self._get_archives().get(
+            (rawpkg.name, ver.ver_str, ver.arch))
+        return size if size == ver.size else 0
+
+    def get_download_size(self, pkg):
+        """ Return the size that needs to be downloaded to install the
+            candidate of pkg, 0 if it is in Dir::Cache::archives already.
+        """
+        if pkg.candidate is None:
+            return 0
+        ver = pkg.candidate._cand
+        return ver.size - self._get_archived_size(pkg._pkg, ver)
+
+    def get_required_download(self):
+        """ The same as required_download, but instead of fetching the
+            archives of the whole depcache, only the debs that are in
+            Dir::Cache::archives are subtracted from the size that the
+            depcache keeps up to date when packages are (un)marked.
+        """
+        size = self._depcache.deb_size
+        for (name, version, arch) in self._get_archives():
+            try:
+                if arch == "all":
+                    rawpkg = self._cache[name]
+                else:
+                    rawpkg = self._cache[(name, arch)]
+            except KeyError:
+                continue
+            if not (self._depcache.marked_install(rawpkg) or
+                    self._depcache.marked_upgrade(rawpkg) or
+                    self._depcache.marked_downgrade(rawpkg) or
+                    self._depcache.marked_reinstall(rawpkg)):
+                continue
+            ver = self._depcache.get_candidate_ver(rawpkg)
+            if ver is not None and ver.ver_str == version:
+                size -= self._get_archived_size(rawpkg, ver)
+
+        if apt_pkg.config.find_b(self.VERIFY_DOWNLOAD_SIZE_KEY, False):
+            required_download = self.required_download
+            if required_download != size:
+                logging.warning("download size %s differs from %s" %
+                                (size, required_download))
+            return required_download
+        return size
+
     @property
     def install_count(self):
         return self._depcache.inst_count
@@ -140,29 +331,80 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
     def keep_count(self):
         return self._depcache.keep_count
 
+    def _get_provides(self, target):
+        """Return the (name, version) of target and of what it provides,
+           the version of an unversioned provides is ""."""
+        provides = [(target.package.shortname, target.version)]
+        for (name, version, ver) in target._cand.provides_list:
+            provides.append((name, version))
+        return provides
+
+    @staticmethod
+    def _provide_matches(base_dep, name, version):
+        """Return True if the dependency matches the (name, version) of a
+           package or of what it provides.  Like apt, an unversioned
+           provides does not satisfy a versioned dependency."""
+        if base_dep.name != name:
+            return False
+        if not base_dep.relation:
+            return True
+        return bool(version) and apt_pkg.check_dep(
+            version, base_dep.relation, base_dep.version)
+
     def _check_dependencies(self, target, deps):
-        """Return True if any of the dependencies in deps match target."""
-        # TODO: handle virtual packages
+        """Return True if any of the dependencies in deps match target,
+           directly or through a virtual package that target provides."""
+        provides = self._get_provides(target)
         for dep_or in deps:
             if not dep_or:
                 continue
             match = True
             for base_dep in dep_or:
-                if (base_dep.name != target.package.shortname or
-                    not apt_pkg.check_dep(
-                        target.version, base_dep.relation, base_dep.version)):
+                if not any(self._provide_matches(base_dep, name, version)
+                           for (name, version) in provides):
                     match = False
             if match:
                 return True
         return False
 
-    def find_removal_justification(self, pkg):
+    def _get_conflicts_replaces_index(self):
+        """Return a dict that maps package names to the (low level)
+           packages whose candidates both Conflict with and Replace them,
+           sorted by name."""
+        index = {}
+        for rawpkg in self._cache.packages:
+            ver = self._depcache.get_candidate_ver(rawpkg)
+            if ver is None:
+                continue
+            depends_list = ver.depends_list
+            if "Conflicts" not in depends_list or \
+                    "Replaces" not in depends_list:
+                continue
+            conflicts = set(dep.target_pkg.name
+                            for dep_or in depends_list["Conflicts"]
+                            for dep in dep_or)
+            replaces = set(dep.target_pkg.name
+                           for dep_or in depends_list["Replaces"]
+                           for dep in dep_or)
+            for name in conflicts & replaces:
+                index.setdefault(name, []).append(rawpkg)
+        for rawpkgs in index.values():
+            rawpkgs.sort(key=lambda rawpkg: rawpkg.get_fullname(True))
+        return index
+
+    def find_removal_justification(self, pkg, conflicts_replaces=None):
+        """Return True if the removal of pkg is justified by a candidate
+           that Conflicts/Replaces it.  conflicts_replaces is the index
+           of _get_conflicts_replaces_index(), which is built if it is
+           not given."""
         target = pkg.installed
         if not target:
             return False
-        for cpkg in self:
-            candidate = cpkg.candidate
-            if candidate is not None:
+        if conflicts_replaces is None:
+            conflicts_replaces = self._get_conflicts_replaces_index()
+        for (name, version) in self._get_provides(target):
+            for rawpkg in conflicts_replaces.get(name, []):
+                candidate = self._rawpkg_to_pkg(rawpkg).candidate
                 if (self._check_dependencies(
                         target, candidate.get_dependencies("Conflicts")) and
                     self._check_dependencies(
@@ -181,8 +423,10 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
         if wouldDelete > 0:
             deleted_pkgs = [pkg for pkg in self if pkg.marked_delete]
             assert wouldDelete == len(deleted_pkgs)
+            # built once for all the packages to delete
+            conflicts_replaces = self._get_conflicts_replaces_index()
             for pkg in deleted_pkgs:
-                if self.find_removal_justification(pkg):
+                if self.find_removal_justification(pkg, conflicts_replaces):
                     wouldDelete -= 1
         if wouldDelete > 0:
             self.clear()
@@ -201,22 +445,83 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
             verstr = "".join(vers_no_epoch[1:])
         return verstr
 
+    def _get_changelog_info(self, name):
+        """ Return a dict with the details of the candidate of the package
+            that are needed to fetch its changelog and NEWS.Debian.  apt
+            is not thread-safe, so they are looked up (and kept) before
+            the fetching is handed to another thread.  Other threads get
+            a LookupError for packages that were not looked up (e.g.
+            because the cache was opened again meanwhile).
+        """
+        info = self._changelog_info.get(name)
+        if info is not None:
+            return info
+        if threading.current_thread() is not self._apt_thread:
+            raise LookupError("the details of %s were not looked up" % name)
+        pkg = self[name]
+        candidate = pkg.candidate
+        info = {
+            "source_name": candidate.source_name,
+            "source_record": candidate.record.get("Source"),
+            "version": candidate.version,
+            "installed_version": getattr(pkg.installed, "version", None),
+            "section": self._depcache.get_candidate_ver(pkg._pkg).section,
+            "uri": candidate.uri,
+            "uris": candidate.uris,
+            "origins": candidate.origins,
+            "deb": None,
+        }
+        if apt_pkg.config.find_b(self.LOCAL_CHANGELOGS_KEY, True):
+            self._get_archives()
+            info["deb"] = self._archive_paths.get(
+                (pkg.shortname, candidate.version, candidate.architecture))
+        self._changelog_info[name] = info
+        return info
+
     def _get_changelog_or_news(self, name, fname, strict_versioning=False,
-                               changelogs_uri=None):
-        " helper that fetches the file in question "
+                               changelogs_uri=None, progress=None):
+        """ helper that fetches the file in question, progress is called
+            with every stanza when it arrives
+        """
+        stanzas = []
+        iterator = self._iter_changelog_or_news(
+            name, fname, strict_versioning, changelogs_uri)
+        try:
+            for stanza in iterator:
+                stanzas.append(stanza)
+                if progress is not None:
+                    progress(stanza)
+        finally:
+            # if progress raised, the download is stopped right away
+            iterator.close()
+        return "".join(stanzas)
+
+    def _iter_changelog_or_news(self, name, fname, strict_versioning=False,
+                                changelogs_uri=None):
+        """ Yield the new stanzas of the file in question, newest first,
+            while they are downloaded
+        """
         # don't touch the gui in this function, it needs to be thread-safe
-        pkg = self[name]
+        info = self._get_changelog_info(name)
+
+        # the deb may have been downloaded already
+        stanzas = self._get_local_changelog_or_news(name, fname,
+                                                    strict_versioning)
+        if stanzas is not None:
+            for stanza in stanzas:
+                yield stanza
+            return
 
         # get the src package name
-        srcpkg = pkg.candidate.source_name
+        srcpkg = info["source_name"]
 
         # assume "main" section
         src_section = "main"
         # use the section of the candidate as a starting point
-        section = pkg._pcache._depcache.get_candidate_ver(pkg._pkg).section
+        section = info["section"]
 
         # get the source version, start with the binaries version
-        srcver_epoch = pkg.candidate.version
+        srcver_epoch = info["version"]
         srcver = self._strip_epoch(srcver_epoch)
         #print("bin: %s" % binver)
 
@@ -231,41 +536,227 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
 
         # the changelogs_uri argument overrides the default changelogs_uri,
         # this is useful for e.g. PPAs where we construct the changelogs
-        # path differently
+        # path differently, otherwise the (base, uri) of every mirror is
+        # tried in order
         if changelogs_uri:
-            uri = changelogs_uri
+            uris = [(None, changelogs_uri)]
         else:
-            uri = CHANGELOGS_URI % (src_section, prefix, srcpkg, srcpkg,
-                                    srcver, fname)
+            path = CHANGELOGS_PATH % (src_section, prefix, srcpkg, srcpkg,
+                                      srcver, fname)
+            uris = [(base, base + path)
+                    for base in self.changelog_mirrors.get_bases()]
+        uri = uris[0][1]
 
         # https uris are not supported when they contain a username/password
         # because the urllib2 https implementation will not check certificates
         # and so its possible to do a man-in-the-middle attack to steal the
         # credentials
-        res = urlsplit(uri)
-        if res.scheme == "https" and res.username:
-            raise HttpsChangelogsUnsupportedError(
-                "https locations with username/password are not"
-                "supported to fetch changelogs")
-
-        # print("Trying: %s " % uri)
-        changelog = urlopen(uri)
-        #print(changelog.read())
-        # do only get the lines that are new
-        alllines = ""
-        regexp = "^%s \((.*)\)(.*)$" % (re.escape(srcpkg))
-
-        while True:
-            line = changelog.readline().decode("UTF-8", "replace")
-            if line == "":
-                break
-            match = re.match(regexp, line)
+        for (base, mirror_uri) in uris:
+            res = urlsplit(mirror_uri)
+            if res.scheme == "https" and res.username:
+                raise HttpsChangelogsUnsupportedError(
+                    "https locations with username/password are not"
+                    "supported to fetch changelogs")
+
+        # the files on changelogs.ubuntu.com are cached by their name,
+        # the others by their uri
+        key = (srcpkg, srcver, changelogs_uri or fname)
+        installed = info["installed_version"]
+        stanzas = None
+        entry = self.changelog_cache.get(*key)
+        if entry is not None:
+            stanzas = self._cut_cache_entry(uri, entry, srcpkg, installed,
+                                            strict_versioning)
+        future = None
+        if stanzas is None:
+            # the binaries of a source are usually fetched at the same
+            # time, only one of them downloads the file and the others
+            # wait for it
+            with self._changelog_downloads_lock:
+                download = self._changelog_downloads.get(key)
+                if download is None:
+                    future = Future()
+                    self._changelog_downloads[key] = future
+            if download is not None:
+                entry = download.result()
+                if entry is not None:
+                    stanzas = self._cut_cache_entry(
+                        uri, entry, srcpkg, installed, strict_versioning)
+        if stanzas is not None:
+            for stanza in stanzas:
+                yield stanza
+            return
+
+        result = []
+        try:
+            for stanza in self._download_changelog_or_news(
+                    uris, key, installed, strict_versioning, result):
+                yield stanza
+        except Exception as e:
+            if future is not None:
+                future.set_exception(e)
+            raise
+        finally:
+            if future is not None:
+                with self._changelog_downloads_lock:
+                    del self._changelog_downloads[key]
+                if not future.done():
+                    # None if the caller stopped before the end, the
+                    # others download it themselves then
+                    future.set_result(result[0] if result else None)
+
+    def _get_local_changelogs(self, name):
+        """ Return a dict that maps the file names of LOCAL_CHANGELOG_FILES
+            to the files that the deb of the candidate in
+            Dir::Cache::archives has.  The deb is read once for both of
+            them.
+        """
+        files = self._local_changelogs.get(name)
+        if files is not None:
+            return files
+        files = {}
+        deb = self._get_changelog_info(name)["deb"]
+        doc_dir = "usr/share/doc/%s/" % name.split(":")[0]
+        if deb:
+            try:
+                # a deb only has one of the alternatives, reading stops
+                # once it is found
+                found = DebArchive.read_files(deb, [
+                    tuple(doc_dir + filename for filename in filenames)
+                    for filenames in self.LOCAL_CHANGELOG_FILES.values()])
+            except Exception as e:
+                logging.warning("can't read the changelog from %s: %s" % (
+                    deb, e))
+                found = {}
+            for (fname, filenames) in self.LOCAL_CHANGELOG_FILES.items():
+                for filename in filenames:
+                    data = found.get(doc_dir + filename)
+                    if data is None:
+                        continue
+                    try:
+                        data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+                    except zlib.error as e:
+                        logging.warning("can't read %s from %s: %s" % (
+                            filename, deb, e))
+                        continue
+                    files[fname] = data.decode("UTF-8", "replace")
+                    break
+            # if the changelog is there, the doc dir is not a symlink to
+            # another package and a missing NEWS.Debian means there is none
+            if "changelog" in files:
+                files.setdefault("NEWS.Debian", "")
+        self._local_changelogs[name] = files
+        return files
+
+    def _get_local_changelog_or_news(self, name, fname,
+                                     strict_versioning=False):
+        """ Return the new stanzas of the file in question from the deb in
+            Dir::Cache::archives, or None if it is not there
+        """
+        text = self._get_local_changelogs(name).get(fname)
+        if text is None:
+            return None
+        info = self._get_changelog_info(name)
+        return [stanza for (stanza, stop) in self._iter_changelog(
+            text.splitlines(True), info["source_name"],
+            info["installed_version"], strict_versioning) if not stop]
+
+    def _cut_cache_entry(self, uri, entry, srcpkg, installed,
+                         strict_versioning):
+        """ Return the new stanzas of the (text, truncated) entry of
+            changelog_cache, or None if it is truncated before the stanza
+            of the installed version
+        """
+        (text, truncated) = entry
+        if text is None:
+            raise HTTPError(uri, 404, "Not Found (cached)", None, None)
+        stanzas = list(self._iter_changelog(
+            text.splitlines(True), srcpkg, installed, strict_versioning))
+        # a truncated entry only helps if it has the stanza to stop at
+        if truncated and not (stanzas and stanzas[-1][1]):
+            return None
+        return [stanza for (stanza, stop) in stanzas if not stop]
+
+    def _open_changelog_or_news(self, uris, key):
+        """ Return the response of the first of the (base, uri) pairs that
+            has the file, the bases that can't be reached or have server
+            errors are reported to changelog_mirrors
+        """
+        error = None
+        for (base, uri) in uris:
+            # print("Trying: %s " % uri)
+            try:
+                # changelogs are text, usually a fifth of it is transferred
+                response = self.connection_pool.urlopen(
+                    uri, {"Accept-Encoding": "gzip"})
+            except HTTPError as e:
+                # a partial mirror may not have it, but is still fine
+                error = e
+                if base and e.code >= 500:
+                    self.changelog_mirrors.failed(base)
+                continue
+            except (IOError, BadStatusLine, socket.error) as e:
+                error = e
+                if base:
+                    self.changelog_mirrors.failed(base)
+                continue
+            if base:
+                self.changelog_mirrors.succeeded(base)
+            return decode_response(response)
+        if isinstance(error, HTTPError) and error.code == 404:
+            self.changelog_cache.put_missing(*key)
+        raise error
+
+    def _download_changelog_or_news(self, uris, key, installed,
+                                    strict_versioning, result):
+        """ Yield the new stanzas of the file while it is downloaded, store
+            it in changelog_cache and append its (text, truncated) entry
+            to result
+        """
+        changelog = self._open_changelog_or_news(uris, key)
+        stanzas = []
+        stop_line = None
+        try:
+            for (stanza, stop) in self._iter_changelog(
+                    (line.decode("UTF-8", "replace")
+                     for line in iter(changelog.readline, b"")),
+                    key[0], installed, strict_versioning):
+                if stop:
+                    stop_line = stanza
+                    break
+                stanzas.append(stanza)
+                yield stanza
+        finally:
+            # the rest is not needed
+            changelog.close()
+        # the line of the stanza that was stopped at is kept, the entry
+        # may be cut at a newer stanza for another installed version
+        if stop_line is not None:
+            stanzas.append(stop_line)
+        entry = ("".join(stanzas), stop_line is not None)
+        self.changelog_cache.put(*(key + entry))
+        result.append(entry)
+
+    def _iter_changelog(self, lines, srcpkg, installed, strict_versioning):
+        """ Yield (stanza, False) for the stanzas in lines that are new
+            compared to the installed version, and (line, True) for the
+            header line of the stanza that it stops at, if any
+        """
+        # strip epoch from installed version
+        # and from changelog too
+        if installed and ":" in installed:
+            installed = installed.split(":", 1)[1]
+        header = srcpkg + " "
+        stanza = []
+        for line in lines:
+            # only check the headers of the stanzas for the version
+            match = None
+            if line.startswith(header):
+                match = CHANGELOG_VERSION_RE.match(line, len(header))
             if match:
-                # strip epoch from installed version
-                # and from changelog too
-                installed = getattr(pkg.installed, "version", None)
-                if installed and ":" in installed:
-                    installed = installed.split(":", 1)[1]
+                if stanza:
+                    yield ("".join(stanza), False)
+                    stanza = []
                 changelogver = match.group(1)
                 if changelogver and ":" in changelogver:
                     changelogver = changelogver.split(":", 1)[1]
@@ -280,14 +771,17 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
                     if (installed and
                             apt_pkg.version_compare(changelogver,
                                                     installed) < 0):
-                        break
+                        yield (line, True)
+                        return
                 else:
                     if (installed and
                             apt_pkg.version_compare(changelogver,
                                                     installed) == 0):
-                        break
-            alllines = alllines + line
-        return alllines
+                        yield (line, True)
+                        return
+            stanza.append(line)
+        if stanza:
+            yield ("".join(stanza), False)
 
     def _extract_ppa_changelog_uri(self, name):
         """Return the changelog URI from the Launchpad API
@@ -299,48 +793,116 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
                             "changelog")
             return None
 
-        cdt = self[name].candidate
-        for uri in cdt.uris:
+        info = self._get_changelog_info(name)
+        reference = self._get_ppa_reference(info)
+        if reference is None:
+            logging.error("Unable to find a valid PPA candidate URL.")
+            return
+
+        key = (info["source_name"], info["version"],
+               self.PPA_CHANGELOG_URI_NAME % reference)
+        entry = self.changelog_cache.get(*key)
+        if entry is not None and entry[0]:
+            return entry[0]
+        with self._launchpad_lock:
+            changelog_uri = self._resolve_ppa_changelog_uri(
+                reference, info["source_name"], info["version"])
+        if changelog_uri:
+            self.changelog_cache.put(*(key + (changelog_uri,)))
+        return changelog_uri
+
+    def _get_ppa_reference(self, info):
+        """ Return the Launchpad reference of the PPA of the candidate
+            with the given _get_changelog_info(), or None
+        """
+        for uri in info["uris"]:
             if urlsplit(uri).hostname != 'ppa.launchpad.net':
                 continue
             match = re.search('http.*/(.*)/(.*)/ubuntu/.*', uri)
             if match is not None:
-                user, ppa = match.group(1), match.group(2)
-                break
-        else:
-            logging.error("Unable to find a valid PPA candidate URL.")
-            return
+                return '~%s/ubuntu/%s' % (match.group(1), match.group(2))
+        return None
 
+    def _get_launchpad_series(self):
+        " the Launchpad distro series that is running, or None "
+        if self._launchpad_series is None:
+            try:
+                ubuntu = self.launchpad.distributions["ubuntu"]
+                self._launchpad_series = ubuntu.getSeries(
+                    name_or_version=get_dist())
+            except Exception as e:
+                logging.warning("Unable to find the distro series on "
+                                "Launchpad: %s" % e)
+                self._launchpad_series = False
+        return self._launchpad_series or None
+
+    def _resolve_ppa_changelog_uri(self, reference, source_name, version):
+        """ Return the changelog URI of the source in the PPA from the
+            Launchpad API, or None.  If there are several updates from the
+            PPA, the published sources of the running series are fetched
+            at once for all of them.
+        """
         # Login on launchpad if we are not already
         if self.launchpad is None:
             self.launchpad = Launchpad.login_anonymously('update-manager',
                                                          'production',
                                                          version='devel')
 
-        archive = self.launchpad.archives.getByReference(
-            reference='~%s/ubuntu/%s' % (user, ppa)
-        )
+        if reference not in self._ppa_archives:
+            self._ppa_archives[reference] = \
+                self.launchpad.archives.getByReference(reference=reference)
+        archive = self._ppa_archives[reference]
         if archive is None:
             logging.error("Unable to retrieve the archive from the Launchpad "
                           "API.")
             return
 
-        spphs = archive.getPublishedSources(source_name=cdt.source_name,
-                                            exact_match=True,
-                                            version=cdt.version)
-        if not spphs:
-            logging.error("No published sources were retrieved from the "
-                          "Launchpad API.")
-            return
+        query = {"status": "Published"}
+        series = self._get_launchpad_series()
+        if series is not None:
+            query["distro_series"] = series
+        sources = self._ppa_sources.get(reference)
+        if sources is None:
+            sources = {}
+            # the sources of the updates from the PPA that were looked up
+            wanted = set((info["source_name"], info["version"])
+                         for info in list(self._changelog_info.values())
+                         if self._get_ppa_reference(info) == reference)
+            if len(wanted) > 1:
+                # the collection is fetched in batches, it is only read
+                # until all of them are found or the limit is reached
+                for spph in itertools.islice(
+                        archive.getPublishedSources(**query),
+                        self.PPA_SOURCES_LIMIT):
+                    source = (spph.source_package_name,
+                              spph.source_package_version)
+                    if source in wanted:
+                        sources[source] = spph
+                        wanted.remove(source)
+                        if not wanted:
+                            break
+            self._ppa_sources[reference] = sources
+        spph = sources.get((source_name, version))
+        if spph is None:
+            # a single update, published after the others were fetched or
+            # not within PPA_SOURCES_LIMIT
+            spphs = archive.getPublishedSources(source_name=source_name,
+                                                exact_match=True,
+                                                version=version, **query)
+            if not spphs:
+                logging.error("No published sources were retrieved from the "
+                              "Launchpad API.")
+                return
+            spph = spphs[0]
 
-        return spphs[0].changelogUrl()
+        return spph.changelogUrl()
 
     def _guess_third_party_changelogs_uri_by_source(self, name):
-        pkg = self[name]
-        deb_uri = pkg.candidate.uri
+        info = self._get_changelog_info(name)
+        deb_uri = info["uri"]
         if deb_uri is None:
             return None
-        srcrec = pkg.candidate.record.get("Source")
+        srcrec = info["source_record"]
         if not srcrec:
             return None
         # srcpkg can be "apt" or "gcc-default (1.0)"
@@ -348,7 +910,7 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
         if "(" in srcrec:
             srcver = srcrec.split("(")[1].rstrip(")")
         else:
-            srcver = pkg.candidate.version
+            srcver = info["version"]
         base_uri = deb_uri.rpartition("/")[0]
         return base_uri + "/%s_%s.changelog" % (srcpkg, srcver)
 
@@ -358,8 +920,7 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
         """
         # there is always a pkg and a pkg.candidate, no need to add
         # check here
-        pkg = self[name]
-        deb_uri = pkg.candidate.uri
+        deb_uri = self._get_changelog_info(name)["uri"]
         if deb_uri:
             return "%s.changelog" % deb_uri.rsplit(".", 1)[0]
         return None
@@ -372,6 +933,41 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
         except Exception as e:
             pass
 
+    def _fetch_news_and_changelog(self, name):
+        """ called by the workers of changelog_prefetcher, return False
+            if it needs to be fetched again
+        """
+        try:
+            self._get_changelog_info(name)
+            self.get_news(name)
+            self.get_changelog(name)
+        except LookupError:
+            logging.debug("the cache was reopened, not fetching the "
+                          "changelog of %s" % name)
+            return False
+        return name in self.all_changes
+
+    def prefetch_changelogs(self, names):
+        """ Fetch the NEWS.Debian and changelogs of the packages in the
+            background, in the given order.  The details of the packages
+            are looked up here, on the calling thread.
+        """
+        if not apt_pkg.config.find_b(self.PREFETCH_CHANGELOGS_KEY, True):
+            return
+        names = [name for name in names if name not in self.all_changes]
+        for name in names:
+            self._get_changelog_info(name)
+        self.changelog_prefetcher.prefetch(names)
+
+    def fetch_changelog(self, name):
+        """ Fetch the NEWS.Debian and changelog of the package in the
+            background, before the prefetched ones.  Return a
+            threading.Event that is set when they are in all_news and
+            all_changes.
+        """
+        self._get_changelog_info(name)
+        return self.changelog_prefetcher.fetch(name)
+
     def get_news(self, name):
         " get the NEWS.Debian file from the changelogs location "
         try:
@@ -381,7 +977,14 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
         if news:
             self.all_news[name] = news
 
-    def _fetch_changelog_for_third_party_package(self, name, origins):
+    def _get_third_party_changelog(self, name, origins):
+        """ Return the changelog of a package that is not from
+            CHANGELOG_ORIGIN, or the error message if there is none
+        """
+        # the changelog in the deb is the same for all the locations
+        stanzas = self._get_local_changelog_or_news(name, "changelog")
+        if stanzas is not None:
+            return "".join(stanzas)
         # Special case for PPAs
         changelogs_uri_ppa = None
         for origin in origins:
@@ -392,49 +995,172 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
                 except Exception:
                     logging.exception("Unable to connect to the Launchpad "
                                       "API.")
-        # Try non official changelog location
-        changelogs_uri_binary = \
-            self._guess_third_party_changelogs_uri_by_binary(name)
-        changelogs_uri_source = \
-            self._guess_third_party_changelogs_uri_by_source(name)
-        error_message = ""
-        for changelogs_uri in [changelogs_uri_ppa,
-                               changelogs_uri_binary,
-                               changelogs_uri_source]:
-            if changelogs_uri:
-                try:
-                    changelog = self._get_changelog_or_news(
-                        name, "changelog", False, changelogs_uri)
-                    self.all_changes[name] += changelog
-                except (HTTPError, HttpsChangelogsUnsupportedError):
-                    # no changelogs_uri or 404
-                    error_message = _(
-                        "This update does not come from a "
-                        "source that supports changelogs.")
-                except (IOError, BadStatusLine, socket.error):
-                    # network errors and others
-                    logging.exception("error on changelog fetching")
-                    error_message = _(
-                        "Failed to download the list of changes. \n"
-                        "Please check your Internet connection.")
-        self.all_changes[name] += error_message
+        changelogs_uris = [changelogs_uri_ppa]
+        # Try non official changelog location, unless the archive is
+        # known not to have them
+        archive_base = self._get_archive_base(name)
+        unsupported = self._is_changelogs_unsupported(archive_base)
+        if not unsupported:
+            changelogs_uris += [
+                self._guess_third_party_changelogs_uri_by_binary(name),
+                self._guess_third_party_changelogs_uri_by_source(name)]
+        changelogs_uris = [uri for (i, uri) in enumerate(changelogs_uris)
+                           if uri and uri not in changelogs_uris[:i]]
+        errors = []
+        if changelogs_uris:
+            (changelog, errors) = self._race_changelogs(name,
+                                                        changelogs_uris)
+            if changelog is not None:
+                return changelog
+        if not errors and not unsupported:
+            return ""
+        if errors and not any(
+                isinstance(error, (HTTPError, HttpsChangelogsUnsupportedError))
+                for error in errors):
+            # network errors and others, see get_changelog()
+            raise errors[0]
+        if errors and all(getattr(error, "code", None) == 404
+                          for error in errors):
+            self._set_changelogs_unsupported(archive_base)
+        # no changelogs_uri or 404
+        return _("This update does not come from a "
+                 "source that supports changelogs.")
+
+    def _race_changelogs(self, name, uris):
+        """ Fetch the changelog from all of the uris at the same time,
+            they are ranked in the given order.  Return the changelog of
+            the first one that has it and the errors of the ones before
+            it, or None and the errors of all of them.  The downloads
+            that can't be used anymore are cancelled.
+        """
+        results = queue.Queue()
+        # the index of the best uri that has the changelog, the ones
+        # after it are cancelled
+        best = [len(uris)]
+
+        def fetch(index, uri):
+            def progress(stanza):
+                if index > best[0]:
+                    raise ChangelogCancelledError(uri)
+            try:
+                results.put((index, self._get_changelog_or_news(
+                    name, "changelog", False, uri, progress), None))
+            except Exception as e:
+                results.put((index, None, e))
+        if len(uris) == 1:
+            fetch(0, uris[0])
+        else:
+            for (index, uri) in enumerate(uris):
+                thread = threading.Thread(target=fetch, args=(index, uri))
+                thread.daemon = True
+                thread.start()
+        changelogs = {}
+        errors = {}
+        # the index of the first uri that did not fail
+        first = 0
+        while first < len(uris):
+            (index, changelog, error) = results.get()
+            if error is None:
+                changelogs[index] = changelog
+                best[0] = min(best[0], index)
+            elif not isinstance(error, ChangelogCancelledError):
+                if not isinstance(error, (HTTPError,
+                                          HttpsChangelogsUnsupportedError,
+                                          IOError, BadStatusLine,
+                                          socket.error)):
+                    best[0] = -1
+                    raise error
+                if not isinstance(error, (HTTPError,
+                                          HttpsChangelogsUnsupportedError)):
+                    logging.warning("error on changelog fetching from "
+                                    "%s: %s" % (uris[index], error))
+                errors[index] = error
+            while first in errors:
+                first += 1
+            if first in changelogs:
+                best[0] = -1
+                return (changelogs[first],
+                        [errors[i] for i in range(first)])
+        return (None, [errors[i] for i in range(len(uris))])
+
+    def _get_archive_base(self, name):
+        """ Return the uri of the archive of the candidate, where its
+            pool/ is, or None if it is not from an archive
+        """
+        deb_uri = self._get_changelog_info(name)["uri"]
+        if not deb_uri:
+            return None
+        (base, pool, path) = deb_uri.partition("/pool/")
+        if not pool:
+            base = deb_uri.rpartition("/")[0]
+        return base + "/"
+
+    def _is_changelogs_unsupported(self, archive_base):
+        " the archive had none of the changelogs lately "
+        when = self._changelogs_unsupported.get(archive_base)
+        return (when is not None and
+                time.time() - when < self.changelog_cache.negative_ttl)
+
+    def _set_changelogs_unsupported(self, archive_base):
+        if archive_base is not None:
+            self._changelogs_unsupported[archive_base] = time.time()
+
+    def _fetch_changelog_for_third_party_package(self, name, origins):
+        try:
+            changelog = self._get_third_party_changelog(name, origins)
+        except (IOError, BadStatusLine, socket.error):
+            changelog = self._get_download_failed_text()
+        self.all_changes[name] += changelog
+
+    def _get_download_failed_text(self):
+        return _("Failed to download the list of changes. \n"
+                 "Please check your Internet connection.")
+
+    def _set_changelog_failed(self, name, changes, error):
+        """ remember that the changelog failed to download because of the
+            network, it is not put into all_changes so that it is fetched
+            again
+        """
+        logging.warning("failed to download the changelog of %s: %s" % (
+            name, error))
+        self.failed_changes[name] = changes + self._get_download_failed_text()
+        self.partial_changes.pop(name, None)
 
     def get_changelog(self, name):
         " get the changelog file from the changelog location "
-        origins = self[name].candidate.origins
-        self.all_changes[name] = _("Changes for %s versions:\n"
-                                   "Installed version: %s\n"
-                                   "Available version: %s\n\n") % \
-            (name, getattr(self[name].installed, "version", None),
-             self[name].candidate.version)
+        info = self._get_changelog_info(name)
+        origins = info["origins"]
+        # all_changes[name] is only set once it is complete, as it may be
+        # read by the main thread while this runs in a prefetch worker
+        changes = _("Changes for %s versions:\n"
+                    "Installed version: %s\n"
+                    "Available version: %s\n\n") % \
+            (name, info["installed_version"], info["version"])
         if self.CHANGELOG_ORIGIN not in [o.origin for o in origins]:
-            self._fetch_changelog_for_third_party_package(name, origins)
+            try:
+                changelog = self._get_third_party_changelog(name, origins)
+            except (IOError, BadStatusLine, socket.error) as e:
+                self._set_changelog_failed(name, changes, e)
+                return
+            self.all_changes[name] = changes + changelog
+            self.failed_changes.pop(name, None)
             return
         # fixup epoch handling version
-        srcpkg = self[name].candidate.source_name
-        srcver_epoch = self[name].candidate.version.replace(':', '%3A')
+        srcpkg = info["source_name"]
+        srcver_epoch = info["version"].replace(':', '%3A')
+        # what arrived so far is in partial_changes[name], so that the
+        # newest stanzas can be shown while the rest is downloaded
+        stanzas = []
+        published = [time.time()]
+
+        def progress(stanza):
+            stanzas.append(stanza)
+            if time.time() - published[0] >= self.PARTIAL_CHANGES_INTERVAL:
+                self.partial_changes[name] = changes + "".join(stanzas)
+                published[0] = time.time()
         try:
-            changelog = self._get_changelog_or_news(name, "changelog")
+            changelog = self._get_changelog_or_news(name, "changelog",
+                                                    progress=progress)
             if len(changelog) == 0:
                 changelog = _("The changelog does not contain any relevant "
                               "changes.\n\n"
@@ -449,9 +1175,8 @@ class MyCache(DistUpgrade.DistUpgradeCache.MyCache):
                           "until the changes become available or try again "
                           "later.") % (srcpkg, srcver_epoch)
         except (IOError, BadStatusLine, socket.error) as e:
-            print("caught exception: ", e)
-            changelog = _("Failed to download the list "
-                          "of changes. \nPlease "
-                          "check your Internet "
-                          "connection.")
-        self.all_changes[name] += changelog
+            self._set_changelog_failed(name, changes, e)
+            return
+        self.all_changes[name] = changes + changelog
+        self.failed_changes.pop(name, None)
+        self.partial_changes.pop(name, None)
@@ -0,0 +1,299 @@
+# PhasingSimulator.py
+# -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
+#
+#  Copyright (c) 2018 Canonical
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+"""
+Predict which machines get a phased update.
+
+UpdateList seeds a random.Random with "<source>-<version>-<machine-id>"
+and holds the update back if randint(0, 100) is above the
+Phased-Update-Percentage of the update.  Doing that for a whole fleet
+with random.seed() is slow, so the seeding and the first draws of the
+Mersenne Twister are done here for many machine ids at once with numpy
+(if available).  The results are the same as the ones of
+UpdateList._is_ignored_phased_update().
+
+The machine ids need to be given as UpdateList reads them, that is as
+the content of /etc/machine-id including the trailing newline.
+"""
+
+from __future__ import print_function
+
+from hashlib import sha512
+import logging
+import random
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# MT19937 parameters, see Modules/_randommodule.c in CPython
+MT_N = 624
+MT_M = 397
+MT_MATRIX_A = 0x9908b0df
+MT_UPPER_MASK = 0x80000000
+MT_LOWER_MASK = 0x7fffffff
+
+# randint(0, 100) draws getrandbits(7) until the result is below 101
+PERCENTAGE_RANGE = 101
+PERCENTAGE_BITS = 7
+
+# number of machines that are seeded at once, the state of the generator
+# is MT_N 32bit words per machine
+CHUNK_SIZE = 16384
+
+
+def get_seed(source_name, version, machine_id):
+    " the seed that UpdateList uses for the given update and machine "
+    return "%s-%s-%s" % (source_name, version, machine_id)
+
+
+def phased_percentage(source_name, version, machine_id):
+    """ Return the percentage of the machine for the update, the machine
+        gets the update if it is not above the Phased-Update-Percentage
+    """
+    rand = random.Random()
+    rand.seed(get_seed(source_name, version, machine_id))
+    return rand.randint(0, PERCENTAGE_RANGE - 1)
+
+
+def _get_init_state():
+    " the state after init_genrand(19650218) "
+    mt = [19650218]
+    for i in range(1, MT_N):
+        prev = mt[i - 1]
+        mt.append((1812433253 * (prev ^ (prev >> 30)) + i) & 0xffffffff)
+    return numpy.array(mt, dtype=numpy.uint32)
+
+
+def _get_keys(seeds):
+    """ Return the init_by_array() keys for the given seeds (all of the
+        same length) as 2D array with one column per seed
+    """
+    # random.seed() turns the seed and its sha512 into a big endian
+    # integer and uses its 32bit words, least significant first
+    data = []
+    for seed in seeds:
+        seed = seed.encode("utf-8")
+        data.append(seed)
+        data.append(sha512(seed).digest())
+    data = numpy.frombuffer(b"".join(data), dtype=numpy.uint8)
+    data = data.reshape(len(seeds), -1)[:, ::-1]
+    padded = numpy.zeros((len(seeds), -(-data.shape[1] // 4) * 4),
+                         dtype=numpy.uint8)
+    padded[:, :data.shape[1]] = data
+    return padded.view("<u4").T.astype(numpy.uint32)
+
+
+def _seed_states(keys):
+    " vectorized init_by_array() for all key columns "
+    key_length = keys.shape[0]
+    mt = numpy.empty((MT_N, keys.shape[1]), dtype=numpy.uint32)
+    mt[:] = _get_init_state()[:, None]
+    i = 1
+    j = 0
+    for k in range(max(MT_N, key_length)):
+        prev = mt[i - 1]
+        mt[i] = ((mt[i] ^ ((prev ^ (prev >> 30)) * numpy.uint32(1664525))) +
+                 keys[j] + numpy.uint32(j))
+        i += 1
+        j += 1
+        if i >= MT_N:
+            mt[0] = mt[MT_N - 1]
+            i = 1
+        if j >= key_length:
+            j = 0
+    for k in range(MT_N - 1):
+        prev = mt[i - 1]
+        mt[i] = ((mt[i] ^ ((prev ^ (prev >> 30)) *
+                           numpy.uint32(1566083941))) - numpy.uint32(i))
+        i += 1
+        if i >= MT_N:
+            mt[0] = mt[MT_N - 1]
+            i = 1
+    mt[0] = MT_UPPER_MASK
+    return mt
+
+
+def _get_output(mt, index):
+    """ Return the tempered output number index of the freshly seeded
+        states (index needs to be below MT_N - MT_M)
+    """
+    y = (mt[index] & MT_UPPER_MASK) | (mt[index + 1] & MT_LOWER_MASK)
+    y = mt[index + MT_M] ^ (y >> 1) ^ ((y & 1) * numpy.uint32(MT_MATRIX_A))
+    y ^= (y >> 11)
+    y ^= (y << 7) & numpy.uint32(0x9d2c5680)
+    y ^= (y << 15) & numpy.uint32(0xefc60000)
+    y ^= (y >> 18)
+    return y
+
+
+def _phased_percentages_numpy(seeds):
+    mt = _seed_states(_get_keys(seeds))
+    percentages = numpy.full(len(seeds), -1, dtype=numpy.int16)
+    pending = numpy.ones(len(seeds), dtype=bool)
+    for index in range(MT_N - MT_M):
+        draws = _get_output(mt, index) >> (32 - PERCENTAGE_BITS)
+        hit = pending & (draws < PERCENTAGE_RANGE)
+        percentages[hit] = draws[hit]
+        pending &= ~hit
+        if not pending.any():
+            break
+    result = percentages.tolist()
+    # more draws needed than we generated, not going to happen in practice
+    for n in numpy.flatnonzero(pending):
+        rand = random.Random()
+        rand.seed(seeds[n])
+        result[n] = rand.randint(0, PERCENTAGE_RANGE - 1)
+    return result
+
+
+def phased_percentages(source_name, version, machine_ids):
+    """ Return the percentages of all given machines for the update, in
+        the same order as machine_ids
+    """
+    seeds = [get_seed(source_name, version, machine_id)
+             for machine_id in machine_ids]
+    if numpy is None:
+        logging.debug("numpy not available, seeding one machine at a time")
+        return [phased_percentage(source_name, version, machine_id)
+                for machine_id in machine_ids]
+    # the key length depends on the length of the seed, group by it
+    by_length = {}
+    for (n, seed) in enumerate(seeds):
+        by_length.setdefault(len(seed.encode("utf-8")), []).append(n)
+    result = [None] * len(seeds)
+    for indices in by_length.values():
+        for start in range(0, len(indices), CHUNK_SIZE):
+            chunk = indices[start:start + CHUNK_SIZE]
+            percentages = _phased_percentages_numpy(
+                [seeds[n] for n in chunk])
+            for (n, percentage) in zip(chunk, percentages):
+                result[n] = percentage
+    return result
+
+
+def simulate(machine_ids, phased_updates):
+    """ Return a dict that maps every (source, version, percentage) of
+        phased_updates to the list of machine ids that would install it
+    """
+    result = {}
+    for (source_name, version, percentage) in phased_updates:
+        machine_percentages = phased_percentages(source_name, version,
+                                                 machine_ids)
+        result[(source_name, version, percentage)] = [
+            machine_id for (machine_id, machine_percentage)
+            in zip(machine_ids, machine_percentages)
+            if machine_percentage <= int(percentage)]
+    return result
+
+
+def get_rollout(machine_percentages):
+    """ Return a list with the number of machines (given by the result of
+        phased_percentages()) that get the update for every
+        Phased-Update-Percentage from 0 to 100
+    """
+    counts = [0] * PERCENTAGE_RANGE
+    for percentage in machine_percentages:
+        counts[percentage] += 1
+    rollout = []
+    total = 0
+    for count in counts:
+        total += count
+        rollout.append(total)
+    return rollout
+
+
+def get_phased_updates(rootdir=None):
+    """ Return the (source, version, percentage) of all phased updates
+        that are candidates in the (optional) apt root
+    """
+    import apt
+    from .UpdateList import UpdateList
+
+    cache = apt.Cache(rootdir=rootdir)
+    records = cache._records
+    phased_updates = set()
+    for rawpkg in cache._cache.packages:
+        ver = cache._depcache.get_candidate_ver(rawpkg)
+        if ver is None or not ver.file_list:
+            continue
+        if not records.lookup(ver.file_list[0]):
+            continue
+        match = UpdateList.PHASED_UPDATES_RE.search(records.record)
+        if match is None:
+            continue
+        phased_updates.add((records.source_pkg or rawpkg.name,
+                            ver.ver_str, match.group(1)))
+    return sorted(phased_updates)
+
+
+def main(args=None):
+    from optparse import OptionParser
+
+    parser = OptionParser(
+        usage="%prog [options] --machine-ids FILE [SOURCE VERSION PERCENTAGE]",
+        description="Predict which machines get phased updates")
+    parser.add_option("--machine-ids",
+                      help="file with one machine id per line")
+    parser.add_option("--aptroot",
+                      help="use the phased updates of this apt root")
+    parser.add_option("--steps", default="",
+                      help="comma separated percentages to show the number "
+                           "of machines for")
+    parser.add_option("--list", action="store_true", default=False,
+                      help="list the machines that get the updates")
+    (options, args) = parser.parse_args(args)
+    if not options.machine_ids or (len(args) % 3 and not options.aptroot):
+        parser.error("need --machine-ids and an apt root or "
+                     "SOURCE VERSION PERCENTAGE")
+
+    with open(options.machine_ids) as f:
+        # UpdateList uses the content of /etc/machine-id, with newline
+        machine_ids = ["%s\n" % line.strip() for line in f if line.strip()]
+    if options.aptroot:
+        phased_updates = get_phased_updates(options.aptroot)
+    else:
+        phased_updates = [tuple(args[i:i + 3])
+                          for i in range(0, len(args), 3)]
+    steps = [int(step) for step in options.steps.split(",") if step]
+
+    for (source_name, version, percentage) in phased_updates:
+        machine_percentages = phased_percentages(source_name, version,
+                                                 machine_ids)
+        receiving = [machine_id.strip() for (machine_id, machine_percentage)
+                     in zip(machine_ids, machine_percentages)
+                     if machine_percentage <= int(percentage)]
+        print("%s %s (%s%%): %s of %s machines" % (
+            source_name, version, percentage, len(receiving),
+            len(machine_ids)))
+        rollout = get_rollout(machine_percentages)
+        for step in steps:
+            print("  at %s%%: %s machines" % (step, rollout[step]))
+        if options.list:
+            for machine_id in receiving:
+                print("  %s" % machine_id)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -28,22 +28,24 @@ import warnings
 warnings.filterwarnings("ignore", "Accessed deprecated property",
                         DeprecationWarning)
 
+from concurrent.futures import ThreadPoolExecutor
 from gettext import gettext as _
 import apt
-import logging
 import itertools
+import logging
 import platform
 import os
 import random
+import re
 import glob
-
-from gi.repository import Gio
+import zlib
 
 from UpdateManager.Core import utils
 
 
 class UpdateItem():
     def __init__(self, pkg, name, icon, to_remove):
+        # the icon is a string (see Gio.Icon.to_string()), the GUI loads it
         self.icon = icon
         self.name = name
         self.pkg = pkg
@@ -55,14 +57,118 @@ class UpdateItem():
         else:
             return self.pkg.marked_delete
 
+    def get_size(self):
+        if self.to_remove:
+            return 0
+        return getattr(self.pkg.candidate, "size", 0)
+
+    def get_download_size(self, cache):
+        """ the size without what is in the apt archives already """
+        if self.to_remove:
+            return 0
+        return cache.get_download_size(self.pkg)
+
+    def as_dict(self, cache):
+        if self.to_remove:
+            version = self.pkg.installed.version
+        else:
+            version = self.pkg.candidate.version
+        return {"package": self.pkg.name,
+                "name": self.name,
+                "version": version,
+                "size": self.get_size(),
+                "download_size": self.get_download_size(cache),
+                "to_remove": self.to_remove}
+
+
+class DependencyClosures():
+    """ The Depends/Recommends closures of several sets of packages.
+
+        All closures are computed together in one pass over the dependency
+        graph of the candidates.  The packages are kept by their apt id,
+        with one bit per set, so that the sets whose closure contains a
+        package are found with a single lookup.
+    """
+
+    DEPENDENCY_TYPES = ("Depends", "Recommends")
+
+    def __init__(self, cache, roots, eventloop_callback=None):
+        self._cache = cache._cache
+        self._depcache = cache._depcache
+        # owned by the (My)Cache, it is cleared when that is reopened
+        self._dependency_cache = cache.dependency_cache
+        # bit n of masks[id] is set if the package is in the closure of
+        # roots[n]
+        self.masks = [0] * self._cache.package_count
+        propagated = [0] * self._cache.package_count
+        worklist = []
+        for (n, pkgs) in enumerate(roots):
+            for pkg in pkgs:
+                rawpkg = pkg._pkg
+                if self._depcache.get_candidate_ver(rawpkg) is None:
+                    continue
+                self.masks[rawpkg.id] |= 1 << n
+                worklist.append(rawpkg)
+
+        visited = 0
+        while worklist:
+            rawpkg = worklist.pop()
+            new = self.masks[rawpkg.id] & ~propagated[rawpkg.id]
+            if not new:
+                continue
+            propagated[rawpkg.id] |= new
+            visited += 1
+            if visited % 200 == 0 and callable(eventloop_callback):
+                # Don't spin the loop for every package.
+                eventloop_callback()
+            for dep in self._get_dependencies(rawpkg):
+                if new & ~self.masks[dep.id]:
+                    self.masks[dep.id] |= new
+                    worklist.append(dep)
+
+    def _get_dependencies(self, rawpkg):
+        """ Return the packages with a candidate that the candidate of
+            rawpkg depends on or recommends, alternatives included.
+        """
+        ver = self._depcache.get_candidate_ver(rawpkg)
+        key = (rawpkg.id, ver.id)
+        dependencies = self._dependency_cache.get(key)
+        if dependencies is not None:
+            return dependencies
+        dependencies = []
+        for dep_type in self.DEPENDENCY_TYPES:
+            for or_group in ver.depends_list.get(dep_type, []):
+                for dep in or_group:
+                    # resolve the name like apt.Cache does
+                    try:
+                        target = self._cache[dep.target_pkg.name]
+                    except KeyError:
+                        continue
+                    if (target.has_versions and
+                            self._depcache.get_candidate_ver(target)):
+                        dependencies.append(target)
+        self._dependency_cache[key] = dependencies
+        return dependencies
+
+    def get_mask(self, pkg):
+        """ Return the bit mask of the sets whose closure contains pkg """
+        return self.masks[pkg._pkg.id]
+
+    def get_names(self, mask):
+        """ Return the names of the packages that are in the closure of
+            one of the sets in mask
+        """
+        return set(rawpkg.get_fullname(True)
+                   for rawpkg in self._cache.packages
+                   if self.masks[rawpkg.id] & mask)
+
 
 class UpdateGroup(UpdateItem):
-    _depcache = {}
 
     def __init__(self, pkg, name, icon, to_remove):
         UpdateItem.__init__(self, pkg, name, icon, to_remove)
         self._items = set()
-        self._deps = set()
+        self._closure = None
         self.core_item = None
         if pkg is not None:
             self.core_item = UpdateItem(pkg, name, icon, to_remove)
@@ -76,61 +182,24 @@ class UpdateGroup(UpdateItem):
 
     def add(self, pkg, cache=None, eventloop_callback=None, to_remove=False):
         name = utils.get_package_label(pkg)
-        icon = Gio.ThemedIcon.new("package")
-        self._items.add(UpdateItem(pkg, name, icon, to_remove))
-        # If the pkg is in self._deps, stop here. We have already calculated
-        # the recursive dependencies for this package, no need to do it again.
-        if cache and pkg.name in cache and pkg.name not in self._deps:
-            if not self._deps:
-                # Initial deps haven't been calculated. As we're checking
-                # whether _deps is empty in is_dependency, we must init now or
-                # it won't be done at all.
-                self._init_deps(cache, eventloop_callback)
-            self._add_deps(pkg, cache, eventloop_callback)
+        self._items.add(UpdateItem(pkg, name, "package", to_remove))
+        # If pkg is in the closure, so are its dependencies. Otherwise it
+        # needs to be calculated again when it's needed.
+        if self._closure is not None and not self._closure.get_mask(pkg):
+            self._closure = None
 
     def contains(self, item):
         return item in self._items
 
-    def _init_deps(self, cache, eventloop_callback):
-        for item in self._items:
-            if item.pkg and item.pkg.name not in self._deps:
-                self._add_deps(item.pkg, cache, eventloop_callback)
-
-    def _add_deps(self, pkg, cache, eventloop_callback):
-        """Adds pkg and dependencies of pkg to the dependency list."""
-        if pkg is None or pkg.candidate is None or pkg.name in self._deps:
-            # This shouldn't really happen. If we land here often, it's a sign
-            # that something has gone wrong. Unless all pkgs are None it's not
-            # a critical issue - a hit to the performance at most.
-            reason = ((not pkg or not pkg.candidate) and
-                      "Package was None or didn't have a candidate." or
-                      "%s already in _deps." % pkg.name)
-            logging.debug("Useless call to _add_deps. %s" % reason)
-            return
-        if len(self._deps) % 200 == 0 and callable(eventloop_callback):
-            # Don't spin the loop every time _add_deps is called.
-            eventloop_callback()
-
-        self._deps.add(pkg.name)
-
-        if pkg.name in self._depcache:
-            for dep in self._depcache[pkg.name]:
-                if dep not in self._deps and dep in cache:
-                    self._add_deps(cache[dep], cache, eventloop_callback)
-        else:
-            candidate = pkg.candidate
-            dependencies = candidate.get_dependencies('Depends', 'Recommends')
-            for dependency_pkg in itertools.chain.from_iterable(dependencies):
-                name = dependency_pkg.name
-                if name not in self._deps and name in cache:
-                    self._depcache.setdefault(pkg.name, []).append(name)
-                    self._add_deps(cache[name], cache, eventloop_callback)
-
     def is_dependency(self, maybe_dep, cache=None, eventloop_callback=None):
-        if not self._deps and cache:
-            self._init_deps(cache, eventloop_callback)
+        if self._closure is None:
+            if not cache:
+                return False
+            pkgs = [item.pkg for item in self._items if item.pkg]
+            self._closure = DependencyClosures(cache, [pkgs],
+                                               eventloop_callback)
 
-        return maybe_dep.name in self._deps
+        return bool(self._closure.get_mask(maybe_dep))
 
     def packages_are_selected(self):
         for item in self.items:
@@ -148,9 +217,22 @@ class UpdateGroup(UpdateItem):
             return 0
         size = 0
         for item in self.items:
-            size += getattr(item.pkg.candidate, "size", 0)
+            size += item.get_size()
         return size
 
+    def get_download_size(self, cache):
+        size = 0
+        for item in self.items:
+            size += item.get_download_size(cache)
+        return size
+
+    def as_dict(self, cache):
+        return {"name": self.name,
+                "icon": self.icon,
+                "size": self.get_total_size(),
+                "download_size": self.get_download_size(cache),
+                "items": [item.as_dict(cache) for item in self.items]}
+
 
 class UpdateApplicationGroup(UpdateGroup):
     def __init__(self, pkg, application, to_remove):
@@ -158,13 +240,14 @@ class UpdateApplicationGroup(UpdateGroup):
         icon = application.get_icon()
         super(UpdateApplicationGroup, self).__init__(pkg, name, icon,
                                                      to_remove)
+        self.application = application
 
 
 class UpdatePackageGroup(UpdateGroup):
     def __init__(self, pkg, to_remove):
         name = utils.get_package_label(pkg)
-        icon = Gio.ThemedIcon.new("package")
-        super(UpdatePackageGroup, self).__init__(pkg, name, icon, to_remove)
+        super(UpdatePackageGroup, self).__init__(pkg, name, "package",
+                                                 to_remove)
 
 
 class UpdateSystemGroup(UpdateGroup):
@@ -172,8 +255,31 @@ class UpdateSystemGroup(UpdateGroup):
         # Translators: the %s is a distro name, like 'Ubuntu' and 'base' as in
         # the core components and packages.
         name = _("%s base") % utils.get_ubuntu_flavor_name(cache=cache)
-        icon = Gio.ThemedIcon.new("distributor-logo")
-        super(UpdateSystemGroup, self).__init__(None, name, icon, to_remove)
+        super(UpdateSystemGroup, self).__init__(None, name,
+                                                "distributor-logo", to_remove)
+
+
+class DesktopApplication():
+    """ The parts of a .desktop file (Gio.DesktopAppInfo) that are needed
+        to group the updates, so that they can be cached.
+    """
+    def __init__(self, filename, display_name, icon, show):
+        self.filename = filename
+        self.display_name = display_name
+        self.icon = icon
+        self.show = show
+
+    def get_filename(self):
+        return self.filename
+
+    def get_display_name(self):
+        return self.display_name
+
+    def get_icon(self):
+        return self.icon
+
+    def should_show(self):
+        return self.show
 
 
 class UpdateOrigin():
@@ -192,6 +298,10 @@ class UpdateList():
     # the key in the debian/control file used to add the phased
     # updates percentage
     PHASED_UPDATES_KEY = "Phased-Update-Percentage"
+    # used to get the percentage from a raw package record
+    PHASED_UPDATES_RE = re.compile(
+        r"^%s:[ \t]*(.*?)[ \t]*$" % PHASED_UPDATES_KEY,
+        re.MULTILINE | re.IGNORECASE)
 
     # the file that contains the uniq machine id
     UNIQ_MACHINE_ID_FILE = "/etc/machine-id"
@@ -200,6 +310,29 @@ class UpdateList():
 
     APP_INSTALL_PATTERN = "/usr/share/app-install/desktop/%s:*.desktop"
 
+    # the files in the cache dir with the app-install desktop files of
+    # each package and the information from the desktop files
+    DESKTOP_FILES_CACHE = "app-install-desktop-files.json"
+    APPLICATIONS_CACHE = "applications.json"
+    # ... and the one with the desktop files installed by each package
+    INSTALLED_DESKTOP_FILES_CACHE = "installed-desktop-files.json"
+    # the number of threads that read the desktop files of the updates
+    APPLICATION_LOOKUP_THREADS = 4
+    APPLICATION_LOOKUP_THREADS_KEY = (
+        "Update-Manager::Application-Lookup-Threads")
+    # the closure of the system base packages, see _load_system_closure
+    SYSTEM_CLOSURE_CACHE = "system-closure.bin"
+    # the groups of the last update(), see load_snapshot
+    SNAPSHOT_CACHE = "update-list.json"
+
+    # the archive (%s is the dist) and origin that security updates come
+    # from, derivatives can point these to their own security suite via
+    # the configuration keys below
+    SECURITY_ARCHIVE = "%s-security"
+    SECURITY_ORIGIN = "Ubuntu"
+    SECURITY_ARCHIVE_KEY = "Update-Manager::Security-Archive"
+    SECURITY_ORIGIN_KEY = "Update-Manager::Security-Origin"
+
     # the configuration key to turn phased-updates always on
     ALWAYS_INCLUDE_PHASED_UPDATES = (
         "Update-Manager::Always-Include-Phased-Updates")
@@ -210,12 +343,25 @@ class UpdateList():
     def __init__(self, parent, dist=None):
         self.dist = dist if dist else platform.dist()[2]
         self.distUpgradeWouldDelete = 0
+        # False for read-only queries, e.g. update-manager --json, which
+        # leave the snapshot and the cache files alone
+        self.save_caches = True
         self.update_groups = []
         self.security_groups = []
         self.kernel_autoremove_groups = []
         self.num_updates = 0
         self.random = random.Random()
         self.ignored_phased_updates = []
+        # the phasing configuration and the (source, version, percentage)
+        # of the candidates by package id, see _init_phased_updates
+        self.always_include_phased_updates = False
+        self.never_include_phased_updates = False
+        self.phased_updates = None
+        # the random percentage per (source, version)
+        self.phased_percentages = {}
+        # ids of the package files that come from the security archive,
+        # built on the first use (see _get_security_file_ids)
+        self.security_file_ids = None
         # a stable machine uniq id
         try:
             with open(self.UNIQ_MACHINE_ID_FILE) as f:
@@ -236,6 +382,14 @@ class UpdateList():
         else:
             self.current_desktop = ''
         self.desktop_cache = {}
+        # desktop file -> [display name, icon, should show] (or None if
+        # it can not be loaded), see _get_application
+        self.applications = None
+        self.applications_changed = False
+        # package -> installed desktop files, see _get_installed_desktop_files
+        self.installed_desktop_files = None
+        # True if the groups come from load_snapshot and not from update()
+        self.from_snapshot = False
 
     def _file_is_application(self, file_path):
         # WARNING: This is called often if there's a lot of updates. A poor
@@ -264,25 +418,156 @@ class UpdateList():
 
         return score
 
-    def _get_application_for_package(self, pkg):
-        desktop_files = []
-        rated_applications = []
+    def _get_applications_stamp(self):
+        # the display name depends on the language and should_show()
+        # on the desktop
+        return [self.current_desktop,
+                [os.environ.get(k) for k in ("LANGUAGE", "LC_ALL",
+                                             "LC_MESSAGES", "LANG")],
+                self.application_dirs,
+                utils.get_mtimes(
+                    self.application_dirs +
+                    [os.path.dirname(self.APP_INSTALL_PATTERN)])]
+
+    def _init_applications(self):
+        if self.applications is None:
+            self.applications = utils.load_cache_file(
+                self.APPLICATIONS_CACHE, self._get_applications_stamp())
+            if self.applications is None:
+                self.applications = {}
+
+    def _read_application(self, desktop_file):
+        """ Return [display name, icon, should show] of the desktop file,
+            or None if it can not be loaded.  This may run in the
+            threads of _load_applications.
+        """
+        # only needed here, so that the update list can be calculated
+        # without loading the GObject introspection
+        from gi.repository import Gio
+
+        try:
+            application = Gio.DesktopAppInfo.new_from_filename(desktop_file)
+            application.set_desktop_env(self.current_desktop)
+            icon = application.get_icon()
+            return [application.get_display_name(),
+                    icon.to_string() if icon else None,
+                    bool(application.should_show())]
+        except Exception as e:
+            logging.warning("Error loading .desktop file %s: %s" %
+                            (desktop_file, e))
+            return None
+
+    def _load_applications(self, desktop_files):
+        """ Read the desktop files that are not cached yet with a pool of
+            threads, as that is mostly waiting for the disk.  The number
+            of threads is configurable, with 1 (or less) they are read
+            one by one when they are needed.
+        """
+        self._init_applications()
+        missing = sorted(set(desktop_file for desktop_file in desktop_files
+                             if desktop_file not in self.applications))
+        threads = apt.apt_pkg.config.find_i(
+            self.APPLICATION_LOOKUP_THREADS_KEY,
+            self.APPLICATION_LOOKUP_THREADS)
+        if threads <= 1 or len(missing) <= 1:
+            return
+        with ThreadPoolExecutor(min(threads, len(missing))) as executor:
+            infos = list(executor.map(self._read_application, missing))
+        # the results are stored here, in the order of the desktop files
+        for (desktop_file, info) in zip(missing, infos):
+            self.applications[desktop_file] = info
+        self.applications_changed = True
+
+    def _get_application(self, desktop_file):
+        """ Return the application of the given desktop file, from the
+            cache if the application directories did not change.
+        """
+        self._init_applications()
+
+        if desktop_file not in self.applications:
+            self.applications[desktop_file] = self._read_application(
+                desktop_file)
+            self.applications_changed = True
 
-        for installed_file in pkg.installed_files:
-            if self._file_is_application(installed_file):
-                desktop_files.append(installed_file)
+        info = self.applications[desktop_file]
+        if info is None:
+            return None
+        return DesktopApplication(desktop_file, *info)
+
+    def _save_applications(self):
+        if self.applications_changed:
+            self._save_cache_file(self.APPLICATIONS_CACHE,
+                                  self._get_applications_stamp(),
+                                  self.applications)
+            self.applications_changed = False
+
+    def _read_installed_desktop_files(self, info_dir):
+        """ Return a dict that maps the package names of the dpkg file lists
+            in info_dir to the desktop files in the application directories
+            that they contain.
+        """
+        installed_desktop_files = {}
+        try:
+            list_files = os.listdir(info_dir)
+        except OSError as e:
+            logging.warning("Could not read %s: %s" % (info_dir, e))
+            return installed_desktop_files
+        for list_file in list_files:
+            if not list_file.endswith(".list"):
+                continue
+            pkg_name = list_file[:-len(".list")]
+            try:
+                with open(os.path.join(info_dir, list_file), "rb") as f:
+                    for line in f:
+                        line = line.rstrip(b"\n")
+                        if not line.endswith(b".desktop"):
+                            continue
+                        path = line.decode("utf-8", "replace")
+                        if self._file_is_application(path):
+                            installed_desktop_files.setdefault(
+                                pkg_name, []).append(path)
+            except IOError as e:
+                logging.warning("Could not read %s: %s" % (list_file, e))
+        return installed_desktop_files
+
+    def _get_installed_desktop_files(self, pkg):
+        """ Return the desktop files in the application directories that
+            are installed by pkg.  This uses an index of all dpkg file
+            lists, instead of reading pkg.installed_files.
+        """
+        if self.installed_desktop_files is None:
+            info_dir = os.path.join(os.path.dirname(
+                apt.apt_pkg.config.find_file("Dir::State::status")), "info")
+            stamp = [info_dir, self.application_dirs,
+                     utils.get_mtimes([info_dir])]
+            self.installed_desktop_files = utils.load_cache_file(
+                self.INSTALLED_DESKTOP_FILES_CACHE, stamp)
+            if self.installed_desktop_files is None:
+                self.installed_desktop_files = \
+                    self._read_installed_desktop_files(info_dir)
+                self._save_cache_file(self.INSTALLED_DESKTOP_FILES_CACHE,
+                                      stamp, self.installed_desktop_files)
+
+        # same lookup as in pkg.installed_files
+        for name in (pkg.name, pkg.fullname):
+            if name in self.installed_desktop_files:
+                return self.installed_desktop_files[name]
+        return []
+
+    def _get_desktop_files(self, pkg):
+        desktop_files = []
+        desktop_files += self._get_installed_desktop_files(pkg)
 
         if pkg.name in self.desktop_cache:
             desktop_files += self.desktop_cache[pkg.name]
+        return desktop_files
 
-        for desktop_file in desktop_files:
-            try:
-                application = Gio.DesktopAppInfo.new_from_filename(
-                    desktop_file)
-                application.set_desktop_env(self.current_desktop)
-            except Exception as e:
-                logging.warning("Error loading .desktop file %s: %s" %
-                                (desktop_file, e))
+    def _get_application_for_package(self, pkg):
+        rated_applications = []
+
+        for desktop_file in self._get_desktop_files(pkg):
+            application = self._get_application(desktop_file)
+            if application is None:
                 continue
             score = self._rate_application_for_package(application, pkg)
             if score > 0:
@@ -300,30 +585,54 @@ class UpdateList():
             logging.warning("_populate_desktop_cache called with empty list "
                             "of packages.")
             return
-        elif len(pkg_names) == 1:
-            # One update; Let glob do the matching.
-            pattern = self.APP_INSTALL_PATTERN % pkg_names[0]
-        else:
-            # More than one update available. Glob all desktop files and store
-            # those that match an upgradeable package.
-            pattern = self.APP_INSTALL_PATTERN % "*"
 
-        for desktop_file in glob.iglob(pattern):
-            try:
-                pkg = desktop_file.split('/')[-1].split(":")[0]
-            except IndexError:
-                # app-install-data desktop file had an unexpected naming
-                # convention. As we can't extract the package name from
-                # the path, just ignore it.
-                logging.error("Could not extract package name from '%s'. "
-                              "File ignored." % desktop_file)
-                continue
+        # Glob all desktop files once and keep the result until the
+        # app-install-data directory changes.
+        stamp = utils.get_mtimes([os.path.dirname(self.APP_INSTALL_PATTERN)])
+        desktop_files = utils.load_cache_file(self.DESKTOP_FILES_CACHE, stamp)
+        if desktop_files is None:
+            desktop_files = {}
+            for desktop_file in glob.iglob(self.APP_INSTALL_PATTERN % "*"):
+                try:
+                    pkg = desktop_file.split('/')[-1].split(":")[0]
+                except IndexError:
+                    # app-install-data desktop file had an unexpected naming
+                    # convention. As we can't extract the package name from
+                    # the path, just ignore it.
+                    logging.error("Could not extract package name from '%s'. "
+                                  "File ignored." % desktop_file)
+                    continue
+                desktop_files.setdefault(pkg, []).append(desktop_file)
+            self._save_cache_file(self.DESKTOP_FILES_CACHE, stamp,
+                                  desktop_files)
 
-            if pkg in pkg_names:
+        for pkg in pkg_names:
+            for desktop_file in desktop_files.get(pkg, []):
                 self.desktop_cache.setdefault(pkg, []).append(desktop_file)
                 logging.debug("App candidate for %s: %s" %
                               (pkg, desktop_file))
 
+    def _get_security_file_ids(self, cache):
+        """ Return the ids of all package files in the cache that come from
+            the security archive (SECURITY_ARCHIVE/SECURITY_ORIGIN, can be
+            overridden via SECURITY_ARCHIVE_KEY/SECURITY_ORIGIN_KEY) and
+            that have an index file.
+        """
+        archive = apt.apt_pkg.config.find(self.SECURITY_ARCHIVE_KEY,
+                                          self.SECURITY_ARCHIVE)
+        if "%s" in archive:
+            archive = archive % self.dist
+        origin = apt.apt_pkg.config.find(self.SECURITY_ORIGIN_KEY,
+                                         self.SECURITY_ORIGIN)
+        file_ids = set()
+        for pkg_file in cache._cache.file_list:
+            if pkg_file.archive != archive or pkg_file.origin != origin:
+                continue
+            indexfile = cache._list.find_index(pkg_file)
+            if indexfile:  # and indexfile.IsTrusted:
+                file_ids.add(pkg_file.id)
+        return file_ids
+
     def _is_security_update(self, pkg):
         """ This will test if the pkg is a security update.
             This includes if there is a newer version in -updates, but also
@@ -335,6 +644,10 @@ class UpdateList():
         """
         if not self.dist:
             return False
+        if self.security_file_ids is None:
+            self.security_file_ids = self._get_security_file_ids(pkg._pcache)
+        if not self.security_file_ids:
+            return False
         inst_ver = pkg._pkg.current_ver
         for ver in pkg._pkg.version_list:
             # discard is < than installed ver
@@ -344,42 +657,104 @@ class UpdateList():
                 continue
             # check if we have a match
             for (verFileIter, index) in ver.file_list:
-                if verFileIter.archive == "%s-security" % self.dist and \
-                        verFileIter.origin == "Ubuntu":
-                    indexfile = pkg._pcache._list.find_index(verFileIter)
-                    if indexfile:  # and indexfile.IsTrusted:
-                        return True
+                if verFileIter.id in self.security_file_ids:
+                    return True
         return False
 
+    def _init_phased_updates(self, cache):
+        """ Read the phasing configuration and the phased update
+            percentages of all upgradable packages in one go, so that
+            _is_ignored_phased_update() does not need to parse records.
+        """
+        self.always_include_phased_updates = apt.apt_pkg.config.find_b(
+            self.ALWAYS_INCLUDE_PHASED_UPDATES, False)
+        self.never_include_phased_updates = apt.apt_pkg.config.find_b(
+            self.NEVER_INCLUDE_PHASED_UPDATES, False)
+        self.phased_updates = {}
+        if self.always_include_phased_updates:
+            return
+
+        depcache = cache._depcache
+        candidates = []
+        for rawpkg in cache._cache.packages:
+            if not (depcache.is_upgradable(rawpkg) or
+                    depcache.marked_install(rawpkg)):
+                continue
+            ver = depcache.get_candidate_ver(rawpkg)
+            if ver is None or not ver.file_list:
+                continue
+            candidates.append((ver.file_list[0], rawpkg, ver))
+        # read the records in the order they are in the package files
+        candidates.sort(key=lambda c: (c[0][0].id, c[0][1]))
+
+        records = cache._records
+        for (ver_file, rawpkg, ver) in candidates:
+            if not records.lookup(ver_file):
+                continue
+            match = self.PHASED_UPDATES_RE.search(records.record)
+            if match is None:
+                self.phased_updates[rawpkg.id] = None
+                continue
+            source_name = records.source_pkg or rawpkg.name
+            self.phased_updates[rawpkg.id] = (
+                source_name, ver.ver_str, match.group(1))
+
+    def _get_phased_percentage(self, source_name, version):
+        """ Return the (stable) percentage of this machine for the given
+            source version, updates with a lower phased update percentage
+            are held back.
+        """
+        key = (source_name, version)
+        if key not in self.phased_percentages:
+            # its important that we always get the same result on
+            # multiple runs of the update-manager, so we need to
+            # feed a seed that is a combination of the pkg/ver/machine
+            self.random.seed("%s-%s-%s" % (
+                source_name, version, self.machine_uniq_id))
+            self.phased_percentages[key] = self.random.randint(0, 100)
+        return self.phased_percentages[key]
+
     def _is_ignored_phased_update(self, pkg):
         """ This will test if the pkg is a phased update and if
             it needs to get installed or ignored.
 
             :return: True if the updates should be ignored
         """
+        if self.phased_updates is None:
+            # not called from update(), read the configuration first
+            self.always_include_phased_updates = apt.apt_pkg.config.find_b(
+                self.ALWAYS_INCLUDE_PHASED_UPDATES, False)
+            self.never_include_phased_updates = apt.apt_pkg.config.find_b(
+                self.NEVER_INCLUDE_PHASED_UPDATES, False)
+            self.phased_updates = {}
+
         # allow the admin to override this
-        if apt.apt_pkg.config.find_b(
-                self.ALWAYS_INCLUDE_PHASED_UPDATES, False):
+        if self.always_include_phased_updates:
             return False
 
-        if self.PHASED_UPDATES_KEY in pkg.candidate.record:
-            if apt.apt_pkg.config.find_b(
-                    self.NEVER_INCLUDE_PHASED_UPDATES, False):
-                logging.info("holding back phased update per configuration")
-                return True
+        if pkg._pkg.id in self.phased_updates:
+            phased_update = self.phased_updates[pkg._pkg.id]
+        else:
+            # not part of the batch from _init_phased_updates
+            phased_update = None
+            if self.PHASED_UPDATES_KEY in pkg.candidate.record:
+                phased_update = (
+                    pkg.candidate.source_name, pkg.candidate.version,
+                    pkg.candidate.record[self.PHASED_UPDATES_KEY])
+            self.phased_updates[pkg._pkg.id] = phased_update
+        if phased_update is None:
+            return False
 
-            # its important that we always get the same result on
-            # multiple runs of the update-manager, so we need to
-            # feed a seed that is a combination of the pkg/ver/machine
-            self.random.seed("%s-%s-%s" % (
-                pkg.candidate.source_name, pkg.candidate.version,
-                self.machine_uniq_id))
-            threshold = pkg.candidate.record[self.PHASED_UPDATES_KEY]
-            percentage = self.random.randint(0, 100)
-            if percentage > int(threshold):
-                logging.info("holding back phased update %s (%s < %s)" % (
-                    pkg.name, threshold, percentage))
-                return True
+        if self.never_include_phased_updates:
+            logging.info("holding back phased update per configuration")
+            return True
+
+        (source_name, version, threshold) = phased_update
+        percentage = self._get_phased_percentage(source_name, version)
+        if percentage > int(threshold):
+            logging.info("holding back phased update %s (%s < %s)" % (
+                pkg.name, threshold, percentage))
+            return True
         return False
 
     def _get_linux_packages(self):
@@ -419,6 +794,47 @@ class UpdateList():
                 'linux-tools-virtual',
                 'linux-virtual']
 
+    def _get_index_files(self):
+        """ the files that the candidates and their dependencies are read
+            from
+        """
+        config = apt.apt_pkg.config
+        paths = [config.find_file("Dir::Cache::pkgcache"),
+                 config.find_file("Dir::State::status"),
+                 config.find_file("Dir::Etc::preferences")]
+        paths.extend(sorted(glob.glob(os.path.join(
+            config.find_dir("Dir::Etc::preferencesparts"), "*"))))
+        paths.extend(sorted(glob.glob(os.path.join(
+            config.find_dir("Dir::State::lists"), "*_Packages*"))))
+        return paths
+
+    def _get_system_closure_stamp(self, meta_names):
+        """ the closure of the system base packages only changes with the
+            package indexes (and pinning)
+        """
+        paths = self._get_index_files()
+        return [meta_names, apt.apt_pkg.config.find("APT::Architecture"),
+                paths, utils.get_mtimes(paths)]
+
+    def _load_system_closure(self, stamp):
+        """ Return the names of the packages in the closure of the system
+            base packages, if they were saved for the given stamp
+        """
+        data = utils.load_binary_cache_file(self.SYSTEM_CLOSURE_CACHE, stamp)
+        if data is None:
+            return None
+        try:
+            data = zlib.decompress(data)
+        except zlib.error as e:
+            logging.warning("Could not read the system closure: %s" % e)
+            return None
+        return set(data.decode("utf-8").split("\0")) - set([""])
+
+    def _save_system_closure(self, stamp, names):
+        data = "\0".join(sorted(names)).encode("utf-8")
+        utils.save_binary_cache_file(self.SYSTEM_CLOSURE_CACHE, stamp,
+                                     zlib.compress(data))
+
     def _make_groups(self, cache, pkgs, eventloop_callback, to_remove=False):
         if not pkgs:
             return []
@@ -426,6 +842,8 @@ class UpdateList():
         app_groups = []
         pkg_groups = []
 
+        self._load_applications(itertools.chain.from_iterable(
+            self._get_desktop_files(pkg) for pkg in pkgs))
         for pkg in pkgs:
             app = self._get_application_for_package(pkg)
             if app is not None:
@@ -434,36 +852,44 @@ class UpdateList():
             else:
                 ungrouped_pkgs.append(pkg)
 
+        if not ungrouped_pkgs:
+            return sorted(app_groups, key=lambda a: a.name.lower())
+
+        # The closures of all application groups and, unless it was saved
+        # before, the one of the system base packages, which is the last one.
+        flavor_package = utils.get_ubuntu_flavor_package(cache=cache)
+        meta_names = [flavor_package, "ubuntu-standard", "ubuntu-minimal"]
+        meta_names.extend(self._get_linux_packages())
+        stamp = self._get_system_closure_stamp(meta_names)
+        system_closure = self._load_system_closure(stamp)
+        roots = [[group.core_item.pkg] for group in app_groups]
+        if system_closure is None:
+            roots.append([cache[name] for name in meta_names
+                          if name in cache])
+        closures = DependencyClosures(cache, roots, eventloop_callback)
+        meta_mask = 1 << len(app_groups)
+        if system_closure is None:
+            system_closure = closures.get_names(meta_mask)
+            self._save_system_closure(stamp, system_closure)
+
         # Stick together applications and their immediate dependencies
         for pkg in list(ungrouped_pkgs):
-            dep_groups = []
-            for group in app_groups:
-                if group.is_dependency(pkg, cache, eventloop_callback):
-                    dep_groups.append(group)
-                    if len(dep_groups) > 1:
-                        break
-            if len(dep_groups) == 1:
-                dep_groups[0].add(pkg, cache, eventloop_callback, to_remove)
+            mask = closures.get_mask(pkg) & ~meta_mask
+            # exactly one application group
+            if mask and not mask & (mask - 1):
+                app_groups[mask.bit_length() - 1].add(pkg,
+                                                      to_remove=to_remove)
                 ungrouped_pkgs.remove(pkg)
 
+        # Separate out system base packages.
         system_group = None
-        if ungrouped_pkgs:
-            # Separate out system base packages. If we have already found an
-            # application for all updates, don't bother.
-            meta_group = UpdateGroup(None, None, None, to_remove)
-            flavor_package = utils.get_ubuntu_flavor_package(cache=cache)
-            meta_pkgs = [flavor_package, "ubuntu-standard", "ubuntu-minimal"]
-            meta_pkgs.extend(self._get_linux_packages())
-            for pkg in meta_pkgs:
-                if pkg in cache:
-                    meta_group.add(cache[pkg])
-            for pkg in ungrouped_pkgs:
-                if meta_group.is_dependency(pkg, cache, eventloop_callback):
-                    if system_group is None:
-                        system_group = UpdateSystemGroup(cache, to_remove)
-                    system_group.add(pkg)
-                else:
-                    pkg_groups.append(UpdatePackageGroup(pkg, to_remove))
+        for pkg in ungrouped_pkgs:
+            if pkg.name in system_closure:
+                if system_group is None:
+                    system_group = UpdateSystemGroup(cache, to_remove)
+                system_group.add(pkg)
+            else:
+                pkg_groups.append(UpdatePackageGroup(pkg, to_remove))
 
         app_groups.sort(key=lambda a: a.name.lower())
         pkg_groups.sort(key=lambda a: a.name.lower())
@@ -472,18 +898,202 @@ class UpdateList():
 
         return app_groups + pkg_groups
 
-    def update(self, cache, eventloop_callback=None):
+    def _get_snapshot_stamp(self):
+        """ everything that the result of update() depends on, besides the
+            apt configuration files
+        """
+        config = apt.apt_pkg.config
+        paths = self._get_index_files()
+        # the auto flags for the kernel autoremoval
+        paths.append(config.find_file("Dir::State::extended_states"))
+        settings = [config.find(key) for key in (
+            "APT::Architecture", self.ALWAYS_INCLUDE_PHASED_UPDATES,
+            self.NEVER_INCLUDE_PHASED_UPDATES, self.SECURITY_ARCHIVE_KEY,
+            self.SECURITY_ORIGIN_KEY)]
+        settings.append(config.value_list("APT::VersionedKernelPackages"))
+        return [paths, utils.get_mtimes(paths), settings, self.dist,
+                self.machine_uniq_id, platform.release(),
+                self._get_applications_stamp()]
+
+    def _get_group_snapshot(self, group):
+        if isinstance(group, UpdateApplicationGroup):
+            kind = "application"
+            desktop_file = group.application.get_filename()
+        elif isinstance(group, UpdateSystemGroup):
+            kind = "system"
+            desktop_file = None
+        else:
+            kind = "package"
+            desktop_file = None
+        items = []
+        if group.core_item is not None:
+            items.append(group.core_item)
+        items.extend(item for item in group.items
+                     if item is not group.core_item)
+        return {"kind": kind,
+                "desktop_file": desktop_file,
+                "to_remove": group.to_remove,
+                "items": [[item.pkg.name, self._get_snapshot_version(item)]
+                          for item in items]}
+
+    def _get_snapshot_version(self, item):
+        if item.to_remove:
+            return item.pkg.installed.version
+        return item.pkg.candidate.version
+
+    def get_snapshot(self):
+        """ Return the groups as names, versions and group membership """
+        return {"num_updates": self.num_updates,
+                "dist_upgrade_would_delete": self.distUpgradeWouldDelete,
+                "held_back": self.held_back,
+                "ignored_phased_updates": [
+                    pkg.name for pkg in self.ignored_phased_updates],
+                "security_groups": [self._get_group_snapshot(group)
+                                    for group in self.security_groups],
+                "update_groups": [self._get_group_snapshot(group)
+                                  for group in self.update_groups],
+                "kernel_autoremove_groups": [
+                    self._get_group_snapshot(group)
+                    for group in self.kernel_autoremove_groups]}
+
+    def as_dict(self, cache):
+        """ Return the groups, their packages and sizes as plain data.  size
+            is the size of the debs, download_size leaves out the ones
+            that are in Dir::Cache::archives already.
+        """
+        return {"num_updates": self.num_updates,
+                "held_back": self.held_back,
+                "download_size": cache.get_required_download(),
+                "security_groups": [group.as_dict(cache)
+                                    for group in self.security_groups],
+                "update_groups": [group.as_dict(cache)
+                                  for group in self.update_groups],
+                "kernel_autoremove_groups": [
+                    group.as_dict(cache)
+                    for group in self.kernel_autoremove_groups]}
+
+    def _save_cache_file(self, name, stamp, data):
+        " utils.save_cache_file(), unless save_caches is False "
+        if self.save_caches:
+            utils.save_cache_file(name, stamp, data)
+
+    def _save_snapshot(self):
+        self._save_cache_file(self.SNAPSHOT_CACHE, self._get_snapshot_stamp(),
+                              self.get_snapshot())
+
+    def _restore_group(self, cache, group_snapshot):
+        to_remove = group_snapshot["to_remove"]
+        pkgs = []
+        for (name, version) in group_snapshot["items"]:
+            pkg = cache[name]
+            ver = pkg.installed if to_remove else pkg.candidate
+            if ver is None or ver.version != version:
+                raise ValueError("%s is not at version %s" % (name, version))
+            pkgs.append(pkg)
+            # mark it like saveDistUpgrade() did
+            if to_remove:
+                pkg.mark_delete(auto_fix=False)
+            else:
+                pkg.mark_install(auto_fix=False, auto_inst=False,
+                                 from_user=False)
+
+        if group_snapshot["kind"] == "application":
+            application = self._get_application(
+                group_snapshot["desktop_file"])
+            if application is None:
+                raise ValueError("%s can not be loaded" %
+                                 group_snapshot["desktop_file"])
+            group = UpdateApplicationGroup(pkgs[0], application, to_remove)
+            pkgs = pkgs[1:]
+        elif group_snapshot["kind"] == "package":
+            group = UpdatePackageGroup(pkgs[0], to_remove)
+            pkgs = pkgs[1:]
+        else:
+            group = UpdateSystemGroup(cache, to_remove)
+        for pkg in pkgs:
+            group.add(pkg, to_remove=to_remove)
+        return group
+
+    def load_snapshot(self, cache):
+        """ Restore the groups of the last update() (and mark the updates
+            in the cache) if nothing they depend on has changed since
+            then.  Return False if there is no usable snapshot, the cache
+            needs to be updated as usual then.
+        """
+        snapshot = utils.load_cache_file(self.SNAPSHOT_CACHE,
+                                         self._get_snapshot_stamp())
+        if snapshot is None:
+            return False
+        try:
+            with cache.actiongroup():
+                security_groups = [self._restore_group(cache, group)
+                                   for group in snapshot["security_groups"]]
+                update_groups = [self._restore_group(cache, group)
+                                 for group in snapshot["update_groups"]]
+                kernel_autoremove_groups = [
+                    self._restore_group(cache, group)
+                    for group in snapshot["kernel_autoremove_groups"]]
+                ignored_phased_updates = [
+                    cache[name] for name in snapshot["ignored_phased_updates"]]
+        except (KeyError, TypeError, ValueError, SystemError) as e:
+            logging.debug("Could not restore the update list snapshot: %s"
+                          % e)
+            cache.clear()
+            return False
+        if cache._depcache.broken_count > 0:
+            logging.debug("The update list snapshot leaves broken packages")
+            cache.clear()
+            return False
+        self._save_applications()
+
+        self.num_updates = snapshot["num_updates"]
+        self.distUpgradeWouldDelete = snapshot["dist_upgrade_would_delete"]
+        self.held_back = snapshot["held_back"]
+        self.ignored_phased_updates = ignored_phased_updates
+        self.security_groups = security_groups
+        self.update_groups = update_groups
+        self.kernel_autoremove_groups = kernel_autoremove_groups
+        self.from_snapshot = True
+        return True
+
+    def _get_changed_packages(self, cache):
+        """ Return the packages that are upgradable, marked for install or
+            kernels that can be removed, sorted by name like the cache.
+            This sweeps over the low level packages, so that apt.Package
+            objects are only created for the few with changes.
+        """
+        depcache = cache._depcache
+        kernel_regexp = cache.versioned_kernel_pkgs_regexp
+        changed = []
+        for rawpkg in cache._cache.packages:
+            installed = rawpkg.current_ver is not None
+            marked_install = depcache.marked_install(rawpkg)
+            if installed and depcache.is_upgradable(rawpkg) or marked_install:
+                changed.append(rawpkg)
+            elif installed and kernel_regexp and depcache.is_garbage(rawpkg):
+                # see the is_auto_removable check in _classify
+                name = rawpkg.get_fullname(True)
+                if (kernel_regexp.match(name) and
+                        not cache.running_kernel_pkgs_regexp.match(name)):
+                    changed.append(rawpkg)
+        changed.sort(key=lambda rawpkg: rawpkg.get_fullname(True))
+        return [cache._rawpkg_to_pkg(rawpkg) for rawpkg in changed]
+
+    def _classify(self, cache):
+        """ Sort the changes that saveDistUpgrade() marked into security
+            updates, other updates and kernels to remove, which are
+            returned.  The held back packages and the ignored phased
+            updates are kept in self.held_back/ignored_phased_updates.
+        """
         self.held_back = []
-
-        # do the upgrade
-        self.distUpgradeWouldDelete = cache.saveDistUpgrade()
+        self._init_phased_updates(cache)
 
         security_pkgs = []
         upgrade_pkgs = []
         kernel_autoremove_pkgs = []
 
         # Find all upgradable packages
-        for pkg in cache:
+        for pkg in self._get_changed_packages(cache):
             if pkg.is_upgradable or pkg.marked_install:
                 if getattr(pkg.candidate, "origins", None) is None:
                     # can happen for e.g. locked packages
@@ -519,6 +1129,18 @@ class UpdateList():
                 kernel_autoremove_pkgs.append(pkg)
                 pkg.mark_delete()
 
+        return (security_pkgs, upgrade_pkgs, kernel_autoremove_pkgs)
+
+    def update(self, cache, eventloop_callback=None):
+        if self.dist:
+            self.security_file_ids = self._get_security_file_ids(cache)
+
+        # do the upgrade
+        self.distUpgradeWouldDelete = cache.saveDistUpgrade()
+
+        (security_pkgs, upgrade_pkgs,
+         kernel_autoremove_pkgs) = self._classify(cache)
+
         if security_pkgs or upgrade_pkgs:
             # There's updates available. Initiate the desktop file cache.
             pkg_names = [p.name for p in
@@ -530,3 +1152,5 @@ class UpdateList():
                                                  eventloop_callback)
         self.kernel_autoremove_groups = self._make_groups(
             cache, kernel_autoremove_pkgs, eventloop_callback, True)
+        self._save_applications()
+        self._save_snapshot()
@@ -32,13 +32,17 @@ import apt
 import apt_pkg
 apt_pkg.init_config()
 
+import hashlib
+import json
 import locale
 import logging
 import re
 import os
 import subprocess
 import sys
+import tempfile
 import time
+import zlib
 try:
     from urllib.request import (
         ProxyHandler,
@@ -58,6 +62,7 @@ except ImportError:
     )
     from urlparse import urlsplit
 
+from collections import OrderedDict
 from copy import copy
 
 
@@ -78,6 +83,152 @@ class ExecutionTime(object):
         print("%s: %s" % (self.info, time.time() - self.now))
 
 
+class LRUCache(object):
+    """
+    A dict like cache that keeps the max_size most recently used
+    entries and counts its hits and misses, e.g. for profiling.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        """ drop all entries, the counters are kept """
+        self._data.clear()
+
+
+def get_cache_dir():
+    """ return the (per user) directory for the cache files of
+        update-manager
+    """
+    cache_dir = os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(cache_dir, "update-manager")
+
+
+def get_mtimes(paths):
+    """ return a list with the mtime of each of the given paths (None if
+        it does not exist), used to detect if a cache file is outdated
+    """
+    mtimes = []
+    for path in paths:
+        try:
+            mtimes.append(os.stat(path).st_mtime)
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+
+def load_cache_file(name, stamp):
+    """ return the data that was stored with save_cache_file() under the
+        given name, or None if there is none or if it was stored with a
+        different stamp
+    """
+    path = os.path.join(get_cache_dir(), name)
+    try:
+        with open(path) as f:
+            cache_file = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    # compare the stamp the way it was stored (e.g. tuples become lists)
+    if cache_file.get("stamp") != json.loads(json.dumps(stamp)):
+        logging.debug("cache file '%s' is outdated" % path)
+        return None
+    return cache_file.get("data")
+
+
+def _write_cache_file(name, content):
+    """ write the bytes in content to the file name in the cache directory
+    """
+    cache_dir = get_cache_dir()
+    try:
+        if not os.path.exists(cache_dir):
+            # ~/.cache needs to be created with mode 0700
+            cache_parent_dir = os.path.dirname(cache_dir)
+            if not os.path.exists(cache_parent_dir):
+                os.mkdir(cache_parent_dir, 0o700)
+            os.mkdir(cache_dir)
+        # write to a temp file and rename it so that readers never see
+        # a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=name)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.rename(tmp_path, os.path.join(cache_dir, name))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+    except (IOError, OSError) as e:
+        logging.warning("could not write cache file '%s': %s" % (name, e))
+
+
+def save_cache_file(name, stamp, data):
+    """ store the (json serializable) data and the stamp under the given
+        name in the cache directory
+    """
+    try:
+        content = json.dumps({"stamp": stamp, "data": data})
+    except (TypeError, ValueError) as e:
+        logging.warning("could not write cache file '%s': %s" % (name, e))
+        return
+    _write_cache_file(name, content.encode("utf-8"))
+
+
+def _get_stamp_hash(stamp):
+    return hashlib.sha1(
+        json.dumps(stamp, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def load_binary_cache_file(name, stamp):
+    """ return the bytes that were stored with save_binary_cache_file()
+        under the given name, or None if there are none or if they were
+        stored with a different stamp
+    """
+    path = os.path.join(get_cache_dir(), name)
+    try:
+        with open(path, "rb") as f:
+            stamp_hash = f.readline().rstrip(b"\n").decode("ascii")
+            data = f.read()
+    except (IOError, OSError, UnicodeDecodeError):
+        return None
+    if stamp_hash != _get_stamp_hash(stamp):
+        logging.debug("cache file '%s' is outdated" % path)
+        return None
+    return data
+
+
+def save_binary_cache_file(name, stamp, data):
+    """ store the bytes in data under the given name in the cache
+        directory, with a hash of the (json serializable) stamp
+    """
+    try:
+        stamp_hash = _get_stamp_hash(stamp)
+    except (TypeError, ValueError) as e:
+        logging.warning("could not write cache file '%s': %s" % (name, e))
+        return
+    _write_cache_file(name, stamp_hash.encode("ascii") + b"\n" + data)
+
+
 def get_string_with_no_auth_from_source_entry(entry):
     tmp = copy(entry)
     url_parts = urlsplit(tmp.uri)
@@ -287,6 +438,81 @@ def url_downloadable(uri, debug_func=None):
     return False
 
 
+class GzipStream(object):
+    """
+    Decompresses a gzip encoded file object (e.g. a http response) while
+    it is read, with read(), readline() and close().
+    """
+    CHUNK_SIZE = 16 * 1024
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        # read1() returns what arrived so far instead of waiting for a
+        # whole chunk
+        self._read = getattr(fileobj, "read1", fileobj.read)
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buffer = b""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """ decompress the next chunk, return False at the end """
+        if self._eof:
+            return False
+        data = self._read(self.CHUNK_SIZE)
+        if data:
+            data = self._decompressor.decompress(data)
+        else:
+            data = self._decompressor.flush()
+            self._eof = True
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def readline(self, limit=-1):
+        while True:
+            end = self._buffer.find(b"\n", self._pos)
+            if end >= 0:
+                end += 1
+                break
+            if not self._fill():
+                end = len(self._buffer)
+                break
+        if limit >= 0:
+            end = min(end, self._pos + limit)
+        line = self._buffer[self._pos:end]
+        self._pos = end
+        return line
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) - self._pos < size:
+            if not self._fill():
+                break
+        if size < 0:
+            end = len(self._buffer)
+        else:
+            end = min(len(self._buffer), self._pos + size)
+        data = self._buffer[self._pos:end]
+        self._pos = end
+        return data
+
+    def info(self):
+        return self._fileobj.info()
+
+    def close(self):
+        self._fileobj.close()
+
+
+def decode_response(response):
+    """ return response, or a GzipStream of it if the server sent it gzip
+        encoded (after an "Accept-Encoding: gzip" request header)
+    """
+    encoding = response.info().get("Content-Encoding", "")
+    if encoding.strip().lower() in ("gzip", "x-gzip"):
+        return GzipStream(response)
+    return response
+
+
 def init_proxy(gsettings=None):
     """ init proxy settings
 
@@ -230,7 +230,8 @@ class UpdateManager(Gtk.Window):
 
     def start_available(self, cancelled_update=False, error_occurred=False):
         self._look_busy()
-        self.refresh_cache()
+        # the updates pane validates the snapshot once it is shown
+        self.refresh_cache(use_snapshot=True)
 
         pane = self._make_available_pane(self.cache.install_count,
                                          os.path.exists(REBOOT_REQUIRED_FILE),
@@ -351,7 +352,7 @@ class UpdateManager(Gtk.Window):
                 # print(self.hwe_replacement_packages)
 
     # fixme: we should probably abstract away all the stuff from libapt
-    def refresh_cache(self):
+    def refresh_cache(self, use_snapshot=False):
         # get the lock
         try:
             apt_pkg.pkgsystem_lock()
@@ -393,7 +394,9 @@ class UpdateManager(Gtk.Window):
 
         self.update_list = UpdateList(self)
         try:
-            self.update_list.update(self.cache, eventloop_callback=iterate)
+            if not (use_snapshot and
+                    self.update_list.load_snapshot(self.cache)):
+                self.update_list.update(self.cache, eventloop_callback=iterate)
         except SystemError as e:
             header = _("Could not calculate the upgrade")
             desc = _("An unresolvable problem occurred while "
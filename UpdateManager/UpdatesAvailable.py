@@ -57,7 +57,7 @@ from gettext import ngettext
 
 from .Core.utils import humanize_size
 from .Core.AlertWatcher import AlertWatcher
-from .Core.UpdateList import UpdateSystemGroup
+from .Core.UpdateList import UpdateList, UpdateSystemGroup
 from .Dialogs import InternalDialog
 
 from DistUpgrade.DistUpgradeCache import NotEnoughFreeSpaceError
@@ -226,6 +226,11 @@ class UpdatesAvailable(InternalDialog):
 
         self.dl_size = 0
         self.connected = True
+        # no changelogs are prefetched on mobile broadband
+        self.metered = False
+        self.list = None
+        # the marks are recalculated by _validate_update_list()
+        self.validating = False
 
         # Used for inhibiting power management
         self.sleep_cookie = None
@@ -235,6 +240,8 @@ class UpdatesAvailable(InternalDialog):
         # Special icon theme for looking up app-install-data icons
         self.app_icons = Gtk.IconTheme.get_default()
         self.app_icons.append_search_path(self.APP_INSTALL_ICONS_PATH)
+        # icon string -> Gio.Icon, see get_app_install_icon
+        self.app_install_icons = {}
 
         # Create Unity launcher quicklist
         # FIXME: instead of passing parent we really should just send signals
@@ -384,6 +391,8 @@ class UpdatesAvailable(InternalDialog):
             self.button_close.set_use_underline(False)
 
     def install_all_updates(self, menu, menuitem, data):
+        if self.validating:
+            return
         self.select_all_upgrades(None)
         self.on_button_install_clicked()
 
@@ -472,15 +481,26 @@ class UpdatesAvailable(InternalDialog):
            files, which refer to icons from app-install-data's icon directory.
            So we look them up here."""
 
-        if not isinstance(icon, Gio.ThemedIcon):
-            return icon  # shouldn't happen
+        if icon is None:
+            return None
+        if icon in self.app_install_icons:
+            return self.app_install_icons[icon]
 
-        info = self.app_icons.choose_icon(icon.get_names(), 16,
-                                          Gtk.IconLookupFlags.FORCE_SIZE)
-        if info is not None:
-            return Gio.FileIcon.new(Gio.File.new_for_path(info.get_filename()))
-        else:
-            return icon  # Assume it's in one of the user's themes
+        # the update list keeps the icons as strings
+        try:
+            gicon = Gio.Icon.new_for_string(icon)
+        except GLib.Error as e:
+            logging.warning("Could not load icon %s: %s" % (icon, e))
+            gicon = None
+        if isinstance(gicon, Gio.ThemedIcon):
+            info = self.app_icons.choose_icon(gicon.get_names(), 16,
+                                              Gtk.IconLookupFlags.FORCE_SIZE)
+            if info is not None:
+                gicon = Gio.FileIcon.new(
+                    Gio.File.new_for_path(info.get_filename()))
+            # else assume it's in one of the user's themes
+        self.app_install_icons[icon] = gicon
+        return gicon
 
     def pkg_label_renderer_data_func(self, cell_layout, renderer, model,
                                      iter, user_data):
@@ -579,11 +599,9 @@ class UpdatesAvailable(InternalDialog):
                   "changelog information."))
         # else, get it from the entwork
         elif self.expander_details.get_expanded():
-            lock = threading.Lock()
-            lock.acquire()
-            changelog_thread = threading.Thread(
-                target=self.cache.get_news_and_changelog, args=(name, lock))
-            changelog_thread.start()
+            # usually prefetched already, if not it is fetched next
+            done = self.cache.fetch_changelog(name)
+            cancelled = threading.Event()
             changes_buffer.set_text("%s\n" %
                                     _("Downloading list of changes..."))
             iter = changes_buffer.get_iter_at_line(1)
@@ -592,9 +610,28 @@ class UpdatesAvailable(InternalDialog):
             self.textview_changes.add_child_at_anchor(button, anchor)
             button.show()
             id = button.connect("clicked",
-                                lambda w, lock: lock.release(), lock)
-            # wait for the dl-thread
-            while lock.locked():
+                                lambda w, cancelled: cancelled.set(),
+                                cancelled)
+            # wait for the prefetcher, show the newest changes already
+            shown = ""
+            while not cancelled.is_set():
+                if done.is_set():
+                    if (name in self.cache.all_changes or
+                            name in self.cache.failed_changes or
+                            self.cache.changelog_prefetcher.is_done(name)):
+                        break
+                    # the prefetcher was cleared, e.g. because the cache
+                    # was opened again
+                    done = self.cache.fetch_changelog(name)
+                partial = self.cache.partial_changes.get(name, "")
+                if len(partial) > len(shown):
+                    text = partial[len(shown):]
+                    if not shown:
+                        # below the cancel button
+                        text = "\n" + text
+                    changes_buffer.insert(changes_buffer.get_end_iter(),
+                                          text)
+                    shown = partial
                 time.sleep(0.01)
                 while Gtk.events_pending():
                     Gtk.main_iteration()
@@ -616,6 +653,8 @@ class UpdatesAvailable(InternalDialog):
             changes += self.cache.all_news[name]
         if name in self.cache.all_changes:
             changes += self.cache.all_changes[name]
+        elif name in self.cache.failed_changes:
+            changes += self.cache.failed_changes[name]
         if changes:
             self.set_changes_buffer(changes_buffer, changes, name, srcpkg)
 
@@ -659,6 +698,8 @@ class UpdatesAvailable(InternalDialog):
         """
         Select all updates
         """
+        if self.validating:
+            return
         self.setBusy(True)
         self.cache.saveDistUpgrade()
         self._toggle_group_headers(True)
@@ -670,6 +711,8 @@ class UpdatesAvailable(InternalDialog):
         """
         Select none updates
         """
+        if self.validating:
+            return
         self.setBusy(True)
         self.cache.clear()
         self._toggle_group_headers(False)
@@ -727,7 +770,9 @@ class UpdatesAvailable(InternalDialog):
         self.button_install.set_sensitive(self.cache.install_count)
         try:
             inst_count = self.cache.install_count
-            self.dl_size = self.cache.required_download
+            # only the archives that are downloaded already are checked,
+            # so this is fast enough to run on every toggle
+            self.dl_size = self.cache.get_required_download()
             download_str = ""
             if self.dl_size != 0:
                 download_str = _("%s will be downloaded.") % (
@@ -822,6 +867,8 @@ class UpdatesAvailable(InternalDialog):
         self.expander_desc.set_vexpand(expanded)
 
     def on_button_install_clicked(self):
+        if self.validating:
+            return
         self.unity.set_install_menuitem_visible(False)
         # print("on_button_install_clicked")
         err_sum = _("Not enough free disk space")
@@ -893,6 +940,7 @@ class UpdatesAvailable(InternalDialog):
             self.updates_changed()
             self.hbox_offline.hide()
             self.connected = True
+            self._prefetch_changelogs()
             # trigger re-showing the current app to get changelog info (if
             # needed)
             self.on_treeview_update_cursor_changed(self.treeview_update)
@@ -913,6 +961,7 @@ class UpdatesAvailable(InternalDialog):
 
     def _on_network_3g_alert(self, watcher, on_3g, is_roaming):
         #print("on 3g: %s; roaming: %s" % (on_3g, is_roaming))
+        self.metered = on_3g or is_roaming
         if is_roaming:
             self.hbox_roaming.show()
             self.hbox_on_3g.hide()
@@ -925,6 +974,8 @@ class UpdatesAvailable(InternalDialog):
 
     def on_update_toggled(self, renderer, path):
         """ a toggle button in the listview was toggled """
+        if self.validating:
+            return
         iter = self.store.get_iter(path)
         data = self.store.get_value(iter, LIST_UPDATE_DATA)
         # make sure that we don't allow to toggle deactivated updates
@@ -992,7 +1043,7 @@ class UpdatesAvailable(InternalDialog):
     def _add_header(self, name, groups):
         total_size = 0
         for group in groups:
-            total_size = total_size + group.get_total_size()
+            total_size = total_size + group.get_download_size(self.cache)
         header_row = [
             name,
             UpdateData(groups, None, None),
@@ -1019,7 +1070,7 @@ class UpdatesAvailable(InternalDialog):
             group_row = [
                 group.name,
                 UpdateData(None, group, group_is_item),
-                humanize_size(group.get_total_size()),
+                humanize_size(group.get_download_size(self.cache)),
                 True
             ]
             group_iter = self.store.append(None, group_row)
@@ -1030,7 +1081,7 @@ class UpdatesAvailable(InternalDialog):
                 item_row = [
                     item.name,
                     UpdateData(None, None, item),
-                    humanize_size(getattr(item.pkg.candidate, "size", 0)),
+                    humanize_size(item.get_download_size(self.cache)),
                     True
                 ]
                 self.store.append(group_iter, item_row)
@@ -1074,4 +1125,113 @@ class UpdatesAvailable(InternalDialog):
         while Gtk.events_pending():
             Gtk.main_iteration()
         self.updates_changed()
+        self._prefetch_changelogs()
+        if self.list.from_snapshot:
+            GLib.idle_add(self._validate_update_list)
+        return False
+
+    def _prefetch_changelogs(self):
+        """ Fetch the changelogs of the updates in the background, the
+            security updates first.
+        """
+        if self.list is None or not self.connected or self.metered:
+            return
+        names = []
+        for group in self.list.security_groups + self.list.update_groups:
+            for item in group.items:
+                if item.pkg.candidate is not None:
+                    names.append(item.pkg.name)
+        self.cache.prefetch_changelogs(names)
+
+    def _get_groups(self, update_list):
+        return (update_list.security_groups + update_list.update_groups +
+                update_list.kernel_autoremove_groups)
+
+    def _get_deselected_updates(self):
+        """ Return the names of the packages of the list that the user
+            has deselected
+        """
+        return set(item.pkg.name for group in self._get_groups(self.list)
+                   for item in group.items if not item.is_selected())
+
+    def _keep_deselected_updates(self, update_list, deselected):
+        """ Keep the packages of the list that the user has deselected,
+            the others are marked like saveDistUpgrade() did
+        """
+        actiongroup = apt_pkg.ActionGroup(self.cache._depcache)
+        for group in self._get_groups(update_list):
+            for item in group.items:
+                try:
+                    if item.pkg.name in deselected:
+                        item.pkg.mark_keep()
+                    elif item.to_remove:
+                        item.pkg.mark_delete(auto_fix=False)
+                    elif item.pkg.name not in update_list.held_back:
+                        item.pkg.mark_install(auto_fix=False,
+                                              auto_inst=False,
+                                              from_user=False)
+                except SystemError:
+                    pass
+        if self.cache._depcache.broken_count:
+            Fix = apt_pkg.ProblemResolver(self.cache._depcache)
+            Fix.resolve_by_keep()
+        del actiongroup
+
+    def _iterate(self):
+        " let the Gtk event loop run during long calculations "
+        while Gtk.events_pending():
+            Gtk.main_iteration()
+
+    def _set_validating(self, validating):
+        """ (de)activate the controls that change the marks or start the
+            installation, the ones that are activated again are updated
+            by updates_changed()
+        """
+        self.validating = validating
+        self.treeview_update.set_sensitive(not validating)
+        if validating:
+            self.button_install.set_sensitive(False)
+            self.unity.set_install_menuitem_visible(False)
+
+    def _restore_marks(self, update_list, deselected):
+        " mark the updates of the list again, except the deselected ones "
+        self.cache.clear()
+        self._keep_deselected_updates(update_list, deselected)
+        self.updates_changed()
+
+    def _validate_update_list(self):
+        """ The update list was restored from a snapshot, calculate it
+            again and show the new one if it differs.  The event loop
+            keeps running meanwhile, only the controls that change the
+            marks are not sensitive, and the updates that the user
+            deselected stay deselected.
+        """
+        snapshot_list = self.list
+        deselected = self._get_deselected_updates()
+        self._set_validating(True)
+        update_list = UpdateList(self.window_main)
+        try:
+            self.cache.clear()
+            update_list.update(self.cache, eventloop_callback=self._iterate)
+        except SystemError as e:
+            logging.warning("could not validate the update list: %s" % e)
+            update_list = None
+        finally:
+            self._set_validating(False)
+        if self.list is not snapshot_list:
+            # another list was set meanwhile, it is newer, but the
+            # calculation changed the marks
+            self._restore_marks(self.list, set())
+            return False
+        if update_list is None:
+            self._restore_marks(snapshot_list, deselected)
+            return False
+        self._keep_deselected_updates(update_list, deselected)
+        self.window_main.update_list = update_list
+        if update_list.get_snapshot() != snapshot_list.get_snapshot():
+            logging.debug("the update list snapshot is outdated")
+            self.set_update_list(update_list)
+        else:
+            self.list = update_list
+            self.updates_changed()
         return False
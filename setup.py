@@ -49,7 +49,8 @@ setup(name='update-manager',
                 ],
       scripts=['update-manager',
                'ubuntu-support-status',
-               'hwe-support-status'
+               'hwe-support-status',
+               'update-manager-phasing-simulator'
                ],
       data_files=[('share/update-manager/gtkbuilder',
                    glob.glob("data/gtkbuilder/*.ui")
@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+# -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
+
+"""
+Benchmark of UpdateList.update() on synthetic apt roots.
+
+Generates apt roots with the given numbers of installed packages (a share
+of them upgradable, from the regular or the security pocket, some of them
+phased, some with desktop files) and times the steps of
+UpdateList.update() separately:
+
+  open             MyCache() on the apt root
+  saveDistUpgrade  marking the upgrade
+  classify         sorting the changes into security/other/kernel updates
+  make_groups      grouping them into applications and packages
+
+e.g. run from the top directory:
+
+  PYTHONPATH=. python3 tests/benchmark_update_list.py \\
+      --sizes 1000,10000,50000 --output results.json
+
+The results are written as JSON, one entry per size.  Only the files in
+the temporary update-manager cache directory are used, so every run
+starts cold.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+import apt
+
+from UpdateManager.Core.MyCache import MyCache
+from UpdateManager.Core.UpdateList import UpdateApplicationGroup, UpdateList
+
+DIST = "lucid"
+ARCHIVE_URI = "http://archive.ubuntu.com/ubuntu"
+LISTS_PREFIX = "archive.ubuntu.com_ubuntu_dists_"
+
+PACKAGE_TEMPLATE = """Package: %(name)s
+Priority: optional
+Section: admin
+Installed-Size: 1
+Maintainer: Foo <foo@bar.com>
+Architecture: all
+Version: %(version)s
+%(extra)sDescription: %(name)s
+ a synthetic package
+"""
+
+RELEASE_TEMPLATE = """Origin: Ubuntu
+Label: Ubuntu
+Suite: %(suite)s
+Version: 10.04
+Codename: %(dist)s
+Date: Thu, 29 Apr 2010 17:24:55 UTC
+Architectures: amd64
+Components: main
+Description: Ubuntu Lucid 10.04
+"""
+
+# Gio.DesktopAppInfo only loads desktop files whose Exec exists
+DESKTOP_TEMPLATE = """[Desktop Entry]
+Type=Application
+Name=%(name)s
+Exec=true
+Icon=%(name)s
+"""
+
+
+def _write(path, content):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def _get_package_name(n):
+    return "pkg-%06d" % n
+
+
+def make_aptroot(path, installed, upgradable, fanout=3, security_share=0.2,
+                 phased_share=0.1, desktop_share=0.05,
+                 app_install_share=0.05, seed=0):
+    """ Create a synthetic apt root in path with the given number of
+        installed packages, of which the given number is upgradable.
+        Every candidate depends on fanout random packages, the shares
+        are the fractions of the upgradable packages that come from the
+        security pocket or are phased, and of all packages that install
+        a desktop file or have one in app-install-data.  Return the
+        number of upgradable packages with a desktop file.
+    """
+    rand = random.Random(seed)
+    names = [_get_package_name(n) for n in range(installed)]
+    upgradable_names = set(rand.sample(names, upgradable))
+    share_dir = os.path.join(path, "usr", "share")
+
+    upgradable_apps = 0
+    status = []
+    pockets = {DIST: [], DIST + "-updates": [], DIST + "-security": []}
+    for (n, name) in enumerate(names):
+        deps = set(_get_package_name(rand.randrange(installed))
+                   for i in range(fanout)) - set([name])
+        extra = ""
+        if deps:
+            extra += "Depends: %s\n" % ", ".join(sorted(deps))
+        status.append(PACKAGE_TEMPLATE % {
+            "name": name, "version": "1.0",
+            "extra": "Status: install ok installed\n" + extra})
+        pockets[DIST].append(PACKAGE_TEMPLATE % {
+            "name": name, "version": "1.0",
+            "extra": extra + "Size: 1000\nFilename: pool/%s_1.0.deb\n" % name})
+        if name in upgradable_names:
+            if rand.random() < security_share:
+                pocket = DIST + "-security"
+            else:
+                pocket = DIST + "-updates"
+                if rand.random() < phased_share:
+                    extra += "Phased-Update-Percentage: %d\n" % (
+                        rand.randrange(100))
+            pockets[pocket].append(PACKAGE_TEMPLATE % {
+                "name": name, "version": "1.1",
+                "extra": extra +
+                "Size: 1000\nFilename: pool/%s_1.1.deb\n" % name})
+        if rand.random() < desktop_share:
+            desktop_file = os.path.join(share_dir, "applications",
+                                        "%s.desktop" % name)
+            _write(desktop_file, DESKTOP_TEMPLATE % {"name": name})
+            _write(os.path.join(path, "var", "lib", "dpkg", "info",
+                                "%s.list" % name),
+                   "/.\n%s\n" % desktop_file)
+            if name in upgradable_names:
+                upgradable_apps += 1
+        if rand.random() < app_install_share:
+            _write(os.path.join(share_dir, "app-install", "desktop",
+                                "%s:%s.desktop" % (name, name)),
+                   DESKTOP_TEMPLATE % {"name": name})
+
+    # the system base packages
+    base_names = rand.sample(names, min(installed, 50))
+    for meta_name in ("ubuntu-minimal", "ubuntu-standard"):
+        extra = "Depends: %s\n" % ", ".join(sorted(base_names))
+        status.append(PACKAGE_TEMPLATE % {
+            "name": meta_name, "version": "1.0",
+            "extra": "Status: install ok installed\n" + extra})
+        pockets[DIST].append(PACKAGE_TEMPLATE % {
+            "name": meta_name, "version": "1.0",
+            "extra": extra + "Size: 1000\n"
+            "Filename: pool/%s_1.0.deb\n" % meta_name})
+
+    _write(os.path.join(path, "var", "lib", "dpkg", "status"),
+           "\n".join(status))
+    os.makedirs(os.path.join(path, "var", "lib", "dpkg", "updates"))
+    os.makedirs(os.path.join(path, "var", "lib", "apt", "lists", "partial"))
+    os.makedirs(os.path.join(path, "var", "cache", "apt", "archives",
+                             "partial"))
+    sources = []
+    for (suite, packages) in pockets.items():
+        sources.append("deb %s %s main\n" % (ARCHIVE_URI, suite))
+        lists_path = os.path.join(path, "var", "lib", "apt", "lists",
+                                  LISTS_PREFIX + suite)
+        _write(lists_path + "_Release",
+               RELEASE_TEMPLATE % {"suite": suite, "dist": DIST})
+        _write(lists_path + "_main_binary-amd64_Packages",
+               "\n".join(packages))
+    _write(os.path.join(path, "etc", "apt", "sources.list"),
+           "".join(sorted(sources)))
+    return upgradable_apps
+
+
+def _time(timings, step, func, *args):
+    start = time.time()
+    result = func(*args)
+    timings[step] = time.time() - start
+    return result
+
+
+def benchmark(aptroot):
+    """ Return the timings of the steps of UpdateList.update() on the
+        apt root and the number of resulting groups
+    """
+    timings = {}
+    cache = _time(timings, "open", MyCache, None, aptroot)
+    updates_list = UpdateList(None, dist=DIST)
+    updates_list.APP_INSTALL_PATTERN = os.path.join(
+        aptroot, "usr", "share", "app-install", "desktop", "%s:*.desktop")
+    updates_list.security_file_ids = updates_list._get_security_file_ids(
+        cache)
+    _time(timings, "saveDistUpgrade", cache.saveDistUpgrade)
+    (security_pkgs, upgrade_pkgs, kernel_autoremove_pkgs) = _time(
+        timings, "classify", updates_list._classify, cache)
+
+    def make_groups():
+        updates_list._populate_desktop_cache(
+            [pkg.name for pkg in security_pkgs + upgrade_pkgs])
+        return (updates_list._make_groups(cache, upgrade_pkgs, None) +
+                updates_list._make_groups(cache, security_pkgs, None))
+    groups = _time(timings, "make_groups", make_groups)
+    return {"timings": timings,
+            "security_updates": len(security_pkgs),
+            "other_updates": len(upgrade_pkgs),
+            "ignored_phased_updates": len(updates_list.ignored_phased_updates),
+            "groups": len(groups),
+            "application_groups": len([
+                group for group in groups
+                if isinstance(group, UpdateApplicationGroup)])}
+
+
+def main(args=None):
+    parser = OptionParser(description="Benchmark UpdateList.update() on "
+                                      "synthetic apt roots")
+    parser.add_option("--sizes", default="1000,10000,50000",
+                      help="comma separated numbers of installed packages")
+    parser.add_option("--upgradable-share", type="float", default=0.05,
+                      help="share of the packages that are upgradable")
+    parser.add_option("--fanout", type="int", default=3,
+                      help="dependencies per package")
+    parser.add_option("--security-share", type="float", default=0.2,
+                      help="share of the updates from the security pocket")
+    parser.add_option("--phased-share", type="float", default=0.1,
+                      help="share of the other updates that are phased")
+    parser.add_option("--desktop-share", type="float", default=0.05,
+                      help="share of the packages with desktop files")
+    parser.add_option("--seed", type="int", default=0)
+    parser.add_option("--output", help="write the results to this file")
+    (options, args) = parser.parse_args(args)
+
+    apt.apt_pkg.config.set("APT::Architecture", "amd64")
+    tmpdir = tempfile.mkdtemp()
+    # start without any update-manager cache files
+    os.environ["XDG_CACHE_HOME"] = os.path.join(tmpdir, "cache")
+    results = []
+    try:
+        for size in [int(size) for size in options.sizes.split(",")]:
+            aptroot = os.path.join(tmpdir, "aptroot-%s" % size)
+            # UpdateList looks for the desktop files in there
+            os.environ["XDG_DATA_DIRS"] = os.path.join(aptroot, "usr",
+                                                       "share")
+            upgradable_apps = make_aptroot(
+                aptroot, size, int(size * options.upgradable_share),
+                fanout=options.fanout,
+                security_share=options.security_share,
+                phased_share=options.phased_share,
+                desktop_share=options.desktop_share,
+                app_install_share=options.desktop_share,
+                seed=options.seed)
+            result = benchmark(aptroot)
+            # otherwise only the fallback to package groups is timed
+            if upgradable_apps and not result["application_groups"]:
+                raise AssertionError(
+                    "none of the %s upgradable applications of the %s "
+                    "packages is in an application group" % (
+                        upgradable_apps, size))
+            result.update({"packages": size,
+                           "upgradable": int(size * options.upgradable_share),
+                           "fanout": options.fanout})
+            results.append(result)
+            print("%s packages: %s" % (size, ", ".join(
+                "%s %.3fs" % (step, result["timings"][step])
+                for step in ("open", "saveDistUpgrade", "classify",
+                             "make_groups"))))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -77,6 +77,35 @@ class TestCache(unittest.TestCase):
             [self.cache["package-one"]],
             [pkg for pkg in self.cache if pkg.marked_delete])
 
+    def test_conflicts_replaces_index(self):
+        index = self.cache._get_conflicts_replaces_index()
+        self.assertEqual([rawpkg.name for rawpkg in index["package-one"]],
+                         ["package-two"])
+        # package-four only Conflicts with package-three
+        self.assertNotIn("package-three", index)
+
+    def test_conflicts_replaces_virtual(self):
+        target = mock.Mock()
+        target.package.shortname = "package-one"
+        target.version = "0.1"
+        target._cand.provides_list = [("virtual-one", "", None)]
+        dep = mock.Mock()
+        dep.name = "virtual-one"
+        dep.relation = ""
+        dep.version = ""
+        self.assertTrue(self.cache._check_dependencies(target, [[dep]]))
+        dep.name = "virtual-two"
+        self.assertFalse(self.cache._check_dependencies(target, [[dep]]))
+        # a versioned dependency does not match an unversioned provides
+        dep.name = "virtual-one"
+        dep.relation = "<<"
+        dep.version = "2.0"
+        self.assertFalse(self.cache._check_dependencies(target, [[dep]]))
+        target._cand.provides_list = [("virtual-one", "1.0", None)]
+        self.assertTrue(self.cache._check_dependencies(target, [[dep]]))
+        dep.relation = ">>"
+        self.assertFalse(self.cache._check_dependencies(target, [[dep]]))
+
 
 if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1] == "-v":
@@ -1,12 +1,15 @@
 #!/usr/bin/python3
 # -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
 
+import gzip
 import random
 import logging
 import multiprocessing
 import os
+import shutil
 import sys
 import tempfile
+import threading
 try:
     from test.support import EnvironmentVarGuard
 except ImportError:
@@ -29,6 +32,10 @@ try:
     from socketserver import TCPServer
 except ImportError:
     from SocketServer import TCPServer
+try:
+    from socketserver import ThreadingTCPServer
+except ImportError:
+    from SocketServer import ThreadingTCPServer
 
 
 from UpdateManager.Core.MetaRelease import (
@@ -55,6 +62,30 @@ class SillyProxyRequestHandler(BaseHTTPRequestHandler):
     do_GET = do_HEAD
 
 
+class MetaReleaseRequestHandler(BaseHTTPRequestHandler):
+    """ serves server.body with an ETag, gzip encoded if accepted """
+    ETAG = '"meta-release-1"'
+
+    def do_GET(self):
+        self.server.requests.append(self.headers)
+        if self.headers.get("If-None-Match") == self.ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = self.server.body
+        self.send_response(200)
+        self.send_header("ETag", self.ETAG)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
 def get_new_dist(current_release):
     """
     common code to test new dist fetching, get the new dist information
@@ -165,6 +196,46 @@ class TestMetaReleaseCore(unittest.TestCase):
             self.assertTrue(len(data) > 0)
             self.assertTrue("<html>" in data)
 
+    def test_download_etag_gzip(self):
+        httpd = ThreadingTCPServer(("localhost", 0), MetaReleaseRequestHandler)
+        httpd.daemon_threads = True
+        with open(os.path.join(CURDIR, "test-data", "meta-release"),
+                  "rb") as f:
+            httpd.body = f.read()
+        httpd.requests = []
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        with patch("UpdateManager.Core.MetaRelease.MetaReleaseCore.download"):
+            meta = MetaReleaseCore()
+        meta.current_dist_name = "karmic"
+        meta.METARELEASE_URI = "http://localhost:%s/meta-release" % (
+            httpd.server_address[1])
+        meta.METARELEASE_FILE = os.path.join(tmpdir, "meta-release")
+        with EnvironmentVarGuard() as environ:
+            for proxy in ("http_proxy", "HTTP_PROXY"):
+                environ.unset(proxy)
+            install_opener(None)
+            for i in range(2):
+                meta.new_dist = None
+                meta.download()
+                self.assertEqual(meta.new_dist.name, "lucid")
+        with open(meta.METARELEASE_FILE, "rb") as f:
+            self.assertEqual(f.read(), httpd.body)
+        with open(meta.METARELEASE_FILE + ".etag") as f:
+            self.assertEqual(f.read(), MetaReleaseRequestHandler.ETAG)
+        self.assertEqual(len(httpd.requests), 2)
+        self.assertEqual(httpd.requests[0]["Accept-Encoding"], "gzip")
+        self.assertNotIn("If-None-Match", httpd.requests[0])
+        # the second download was not modified
+        self.assertEqual(httpd.requests[1]["If-None-Match"],
+                         MetaReleaseRequestHandler.ETAG)
+
     @patch("UpdateManager.Core.MetaRelease.MetaReleaseCore.download")
     def test_parse_fails_for_all_non_tagfiles(self, mock_download):
         meta = MetaReleaseCore()
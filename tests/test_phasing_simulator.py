@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+# -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
+
+import os
+import random
+import unittest
+
+import apt
+
+from UpdateManager.Core import PhasingSimulator
+from UpdateManager.Core import UpdateList
+
+CURDIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class PhasingSimulatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rand = random.Random(42)
+        self.machine_ids = ["%032x\n" % rand.getrandbits(128)
+                            for i in range(500)]
+        # a few odd ones, with different seed lengths
+        self.machine_ids.extend(["x\n", "éé\n", "abc"])
+
+    def test_same_as_update_list(self):
+        updates_list = UpdateList.UpdateList(parent=None, dist="lucid")
+        percentages = PhasingSimulator.phased_percentages(
+            "zsh", "4.3.10-5ubuntu3", self.machine_ids)
+        for (machine_id, percentage) in zip(self.machine_ids, percentages):
+            updates_list.machine_uniq_id = machine_id
+            updates_list.phased_percentages = {}
+            self.assertEqual(
+                updates_list._get_phased_percentage("zsh", "4.3.10-5ubuntu3"),
+                percentage)
+
+    @unittest.skipIf(PhasingSimulator.numpy is None, "needs numpy")
+    def test_vectorized_same_as_random(self):
+        percentages = PhasingSimulator.phased_percentages(
+            "linux", "4.15.0-20.21", self.machine_ids)
+        self.assertEqual(
+            percentages,
+            [PhasingSimulator.phased_percentage("linux", "4.15.0-20.21", m)
+             for m in self.machine_ids])
+
+    def test_simulate(self):
+        result = PhasingSimulator.simulate(
+            self.machine_ids, [("zsh", "1.0", "0"), ("zsh", "1.0", "100")])
+        self.assertEqual(result[("zsh", "1.0", "100")], self.machine_ids)
+        self.assertLess(len(result[("zsh", "1.0", "0")]),
+                        len(self.machine_ids))
+        rollout = PhasingSimulator.get_rollout(
+            PhasingSimulator.phased_percentages("zsh", "1.0",
+                                                self.machine_ids))
+        self.assertEqual(len(rollout), 101)
+        self.assertEqual(rollout[0], len(result[("zsh", "1.0", "0")]))
+        self.assertEqual(rollout[100], len(self.machine_ids))
+
+    def test_phased_updates_from_aptroot(self):
+        real_arch = apt.apt_pkg.config.find("APT::Architecture")
+        apt.apt_pkg.config.set("APT::Architecture", "amd64")
+        self.addCleanup(
+            lambda: apt.apt_pkg.config.set("APT::Architecture", real_arch))
+        aptroot = os.path.join(CURDIR, "aptroot-update-list-test")
+        self.assertEqual(PhasingSimulator.get_phased_updates(aptroot),
+                         [("zsh", "4.3.10-5ubuntu3", "10")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,23 +1,204 @@
 #!/usr/bin/python3
 # -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
 
+import itertools
+import logging
 import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
 
 import apt
 import unittest
 
-from UpdateManager.Core import UpdateList
+from UpdateManager.Core import UpdateList, utils
 from UpdateManager.Core.MyCache import MyCache
 
+from gettext import gettext as _
 from gi.repository import Gio
 from mock import patch, PropertyMock, MagicMock
 
 CURDIR = os.path.dirname(os.path.abspath(__file__))
 
 
+def use_temp_cache_dir(test):
+    """ make sure that the update-manager cache files of the test case
+        are not shared with other tests or the real system
+    """
+    cache_home = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, cache_home)
+    patcher = patch.dict(os.environ, {"XDG_CACHE_HOME": cache_home})
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+
+# The grouping of the baseline UpdateList, copied verbatim from
+# UpdateManager/Core/UpdateList.py before the DependencyClosures rewrite.
+# Only the class names got a Baseline prefix and _make_groups became a
+# function.  test_groups_same_as_reference compares against it, don't fix
+# or optimize it.
+
+class BaselineUpdateGroup(UpdateList.UpdateGroup):
+    _depcache = {}
+
+    def __init__(self, pkg, name, icon, to_remove):
+        UpdateList.UpdateItem.__init__(self, pkg, name, icon, to_remove)
+        self._items = set()
+        self._deps = set()
+        self.core_item = None
+        if pkg is not None:
+            self.core_item = UpdateList.UpdateItem(pkg, name, icon, to_remove)
+            self._items.add(self.core_item)
+
+    def add(self, pkg, cache=None, eventloop_callback=None, to_remove=False):
+        name = utils.get_package_label(pkg)
+        icon = Gio.ThemedIcon.new("package")
+        self._items.add(UpdateList.UpdateItem(pkg, name, icon, to_remove))
+        # If the pkg is in self._deps, stop here. We have already calculated
+        # the recursive dependencies for this package, no need to do it again.
+        if cache and pkg.name in cache and pkg.name not in self._deps:
+            if not self._deps:
+                # Initial deps haven't been calculated. As we're checking
+                # whether _deps is empty in is_dependency, we must init now or
+                # it won't be done at all.
+                self._init_deps(cache, eventloop_callback)
+            self._add_deps(pkg, cache, eventloop_callback)
+
+    def _init_deps(self, cache, eventloop_callback):
+        for item in self._items:
+            if item.pkg and item.pkg.name not in self._deps:
+                self._add_deps(item.pkg, cache, eventloop_callback)
+
+    def _add_deps(self, pkg, cache, eventloop_callback):
+        """Adds pkg and dependencies of pkg to the dependency list."""
+        if pkg is None or pkg.candidate is None or pkg.name in self._deps:
+            # This shouldn't really happen. If we land here often, it's a sign
+            # that something has gone wrong. Unless all pkgs are None it's not
+            # a critical issue - a hit to the performance at most.
+            reason = ((not pkg or not pkg.candidate) and
+                      "Package was None or didn't have a candidate." or
+                      "%s already in _deps." % pkg.name)
+            logging.debug("Useless call to _add_deps. %s" % reason)
+            return
+        if len(self._deps) % 200 == 0 and callable(eventloop_callback):
+            # Don't spin the loop every time _add_deps is called.
+            eventloop_callback()
+
+        self._deps.add(pkg.name)
+
+        if pkg.name in self._depcache:
+            for dep in self._depcache[pkg.name]:
+                if dep not in self._deps and dep in cache:
+                    self._add_deps(cache[dep], cache, eventloop_callback)
+        else:
+            candidate = pkg.candidate
+            dependencies = candidate.get_dependencies('Depends', 'Recommends')
+            for dependency_pkg in itertools.chain.from_iterable(dependencies):
+                name = dependency_pkg.name
+                if name not in self._deps and name in cache:
+                    self._depcache.setdefault(pkg.name, []).append(name)
+                    self._add_deps(cache[name], cache, eventloop_callback)
+
+    def is_dependency(self, maybe_dep, cache=None, eventloop_callback=None):
+        if not self._deps and cache:
+            self._init_deps(cache, eventloop_callback)
+
+        return maybe_dep.name in self._deps
+
+
+class BaselineUpdateApplicationGroup(BaselineUpdateGroup):
+    def __init__(self, pkg, application, to_remove):
+        name = application.get_display_name()
+        icon = application.get_icon()
+        super(BaselineUpdateApplicationGroup, self).__init__(pkg, name, icon,
+                                                             to_remove)
+
+
+class BaselineUpdatePackageGroup(BaselineUpdateGroup):
+    def __init__(self, pkg, to_remove):
+        name = utils.get_package_label(pkg)
+        icon = Gio.ThemedIcon.new("package")
+        super(BaselineUpdatePackageGroup, self).__init__(pkg, name, icon,
+                                                         to_remove)
+
+
+class BaselineUpdateSystemGroup(BaselineUpdateGroup):
+    def __init__(self, cache, to_remove):
+        # Translators: the %s is a distro name, like 'Ubuntu' and 'base' as in
+        # the core components and packages.
+        name = _("%s base") % utils.get_ubuntu_flavor_name(cache=cache)
+        icon = Gio.ThemedIcon.new("distributor-logo")
+        super(BaselineUpdateSystemGroup, self).__init__(None, name, icon,
+                                                        to_remove)
+
+
+def baseline_make_groups(self, cache, pkgs, eventloop_callback,
+                         to_remove=False):
+    if not pkgs:
+        return []
+    ungrouped_pkgs = []
+    app_groups = []
+    pkg_groups = []
+
+    for pkg in pkgs:
+        app = self._get_application_for_package(pkg)
+        if app is not None:
+            app_group = BaselineUpdateApplicationGroup(pkg, app, to_remove)
+            app_groups.append(app_group)
+        else:
+            ungrouped_pkgs.append(pkg)
+
+    # Stick together applications and their immediate dependencies
+    for pkg in list(ungrouped_pkgs):
+        dep_groups = []
+        for group in app_groups:
+            if group.is_dependency(pkg, cache, eventloop_callback):
+                dep_groups.append(group)
+                if len(dep_groups) > 1:
+                    break
+        if len(dep_groups) == 1:
+            dep_groups[0].add(pkg, cache, eventloop_callback, to_remove)
+            ungrouped_pkgs.remove(pkg)
+
+    system_group = None
+    if ungrouped_pkgs:
+        # Separate out system base packages. If we have already found an
+        # application for all updates, don't bother.
+        meta_group = BaselineUpdateGroup(None, None, None, to_remove)
+        flavor_package = utils.get_ubuntu_flavor_package(cache=cache)
+        meta_pkgs = [flavor_package, "ubuntu-standard", "ubuntu-minimal"]
+        meta_pkgs.extend(self._get_linux_packages())
+        for pkg in meta_pkgs:
+            if pkg in cache:
+                meta_group.add(cache[pkg])
+        for pkg in ungrouped_pkgs:
+            if meta_group.is_dependency(pkg, cache, eventloop_callback):
+                if system_group is None:
+                    system_group = BaselineUpdateSystemGroup(cache, to_remove)
+                system_group.add(pkg)
+            else:
+                pkg_groups.append(BaselineUpdatePackageGroup(pkg, to_remove))
+
+    app_groups.sort(key=lambda a: a.name.lower())
+    pkg_groups.sort(key=lambda a: a.name.lower())
+    if system_group:
+        pkg_groups.append(system_group)
+
+    return app_groups + pkg_groups
+
+
+def group_names(groups):
+    """ the core package and the package names of groups, to compare them """
+    return [(g.core_item.pkg.name if g.core_item else "",
+             sorted(x.pkg.name for x in g.items)) for g in groups]
+
+
 class PhasedTestCase(unittest.TestCase):
 
     def setUp(self):
+        use_temp_cache_dir(self)
         # mangle the arch
         real_arch = apt.apt_pkg.config.find("APT::Architecture")
         apt.apt_pkg.config.set("APT::Architecture", "amd64")
@@ -64,6 +245,17 @@ class PhasedTestCase(unittest.TestCase):
         self.assertEqual(install_srcs, set({'apt'}))
         self.assertTrue(len(ignored_srcs & install_srcs) == 0)
 
+    def test_phased_percentage_once_per_source(self):
+        """ Test that binaries of the same source share one decision """
+        with patch.object(self.updates_list.random, "randint") as mock_randint:
+            mock_randint.return_value = 11
+            self.updates_list.update(self.cache)
+            self.assertEqual(mock_randint.call_count, 1)
+        self.assertEqual(
+            sorted([pkg.name for pkg in
+                    self.updates_list.ignored_phased_updates]),
+            ["zsh", "zsh-dev"])
+
     def test_phased_percentage_included_via_force(self):
         """ Test that the "always" override config works """
         # set config to force override
@@ -102,10 +294,9 @@ class PhasedTestCase(unittest.TestCase):
 
 
 class GroupingTestCase(unittest.TestCase):
-    # installed_files does not respect aptroot, so we have to patch it
-    @patch('apt.package.Package.installed_files', new_callable=PropertyMock)
     @patch('gi.repository.Gio.DesktopAppInfo.new_from_filename')
-    def setUp(self, mock_desktop, mock_installed):
+    def setUp(self, mock_desktop):
+        use_temp_cache_dir(self)
         # mangle the arch
         real_arch = apt.apt_pkg.config.find("APT::Architecture")
         apt.apt_pkg.config.set("APT::Architecture", "amd64")
@@ -116,19 +307,10 @@ class GroupingTestCase(unittest.TestCase):
         self.cache = MyCache(apt.progress.base.OpProgress(),
                              rootdir=self.aptroot)
         self.cache.open()
-        mock_installed.__get__ = self.fake_installed_files
         mock_desktop.side_effect = self.fake_desktop
         self.updates_list = UpdateList.UpdateList(parent=None, dist='lucid')
         self.updates_list.update(self.cache)
 
-    def fake_installed_files(self, mock_prop, pkg, pkg_class):
-        if pkg.name == 'installed-app':
-            return ['/usr/share/applications/installed-app.desktop']
-        elif pkg.name == 'installed-app-with-subitems':
-            return ['/usr/share/applications/installed-app2.desktop']
-        else:
-            return []
-
     def fake_desktop(self, path):
         # These can all be the same for our purposes
         app = MagicMock()
@@ -146,6 +328,45 @@ class GroupingTestCase(unittest.TestCase):
         self.assertListEqual([x.pkg.name for x in group.items],
                              ['installed-app'])
 
+    @patch('apt.package.Package.installed_files', new_callable=PropertyMock)
+    @patch('gi.repository.Gio.DesktopAppInfo.new_from_filename')
+    def test_app_info_cached(self, mock_desktop, mock_installed):
+        # the desktop files were already loaded in setUp
+        updates_list = UpdateList.UpdateList(parent=None, dist='lucid')
+        updates_list.update(self.cache)
+        self.assertFalse(mock_desktop.called)
+        self.assertListEqual(
+            [(g.name, g.icon) for g in updates_list.update_groups],
+            [(g.name, g.icon) for g in self.updates_list.update_groups])
+        self.assertFalse(mock_installed.called)
+
+    @patch('gi.repository.Gio.DesktopAppInfo.new_from_filename')
+    def test_application_lookup_threads(self, mock_desktop):
+        mock_desktop.side_effect = self.fake_desktop
+        key = UpdateList.UpdateList.APPLICATION_LOOKUP_THREADS_KEY
+        self.addCleanup(lambda: apt.apt_pkg.config.clear(key))
+        pkgs = [pkg for pkg in self.cache if pkg.is_upgradable]
+        results = []
+        for threads in ("1", "4"):
+            apt.apt_pkg.config.set(key, threads)
+            updates_list = UpdateList.UpdateList(parent=None, dist='lucid')
+            # read the desktop files again
+            updates_list.applications = {}
+            groups = updates_list._make_groups(self.cache, pkgs, None)
+            results.append([(g.name, g.icon, [x.pkg.name for x in g.items])
+                            for g in groups])
+        self.assertListEqual(results[0], results[1])
+        # the two desktop files, serially and with threads
+        self.assertEqual(mock_desktop.call_count, 4)
+
+    def test_installed_desktop_files(self):
+        self.assertEqual(
+            self.updates_list.installed_desktop_files,
+            {'installed-app':
+                ['/usr/share/applications/installed-app.desktop'],
+             'installed-app-with-subitems':
+                ['/usr/share/applications/installed-app2.desktop']})
+
     def test_app_with_subitems(self):
         self.assertGreater(len(self.updates_list.update_groups), 1)
         group = self.updates_list.update_groups[1]
@@ -176,6 +397,135 @@ class GroupingTestCase(unittest.TestCase):
         self.assertListEqual([x.pkg.name for x in group.items],
                              ['installed-pkg-multiple-deps'])
 
+    def test_groups_same_as_reference(self):
+        rand = random.Random(0)
+        all_pkgs = [pkg for pkg in self.cache if pkg.candidate is not None]
+        for i in range(20):
+            pkgs = rand.sample(all_pkgs, rand.randint(1, len(all_pkgs)))
+            groups = self.updates_list._make_groups(self.cache, pkgs, None)
+            self.assertListEqual(
+                group_names(groups),
+                group_names(baseline_make_groups(self.updates_list,
+                                                 self.cache, pkgs, None)))
+
+    def test_is_dependency(self):
+        group = UpdateList.UpdateGroup(None, None, None, False)
+        group.add(self.cache["installed-app-with-subitems"])
+        self.assertTrue(group.is_dependency(
+            self.cache["installed-pkg-single-dep"], self.cache))
+        self.assertFalse(group.is_dependency(
+            self.cache["installed-pkg"], self.cache))
+
+    def test_dependency_cache(self):
+        dependency_cache = self.cache.dependency_cache
+        self.assertGreater(len(dependency_cache), 0)
+        pkgs = [pkg for pkg in self.cache if pkg.is_upgradable]
+        self.updates_list._make_groups(self.cache, pkgs, None)
+        misses = dependency_cache.misses
+        self.updates_list._make_groups(self.cache, pkgs, None)
+        self.assertEqual(dependency_cache.misses, misses)
+        self.assertGreater(dependency_cache.hits, 0)
+        # reopening the cache drops the dependencies
+        self.cache.open()
+        self.assertEqual(len(self.cache.dependency_cache), 0)
+
+    def test_system_closure_cached(self):
+        # the closure of the system base packages was saved in setUp
+        with patch.object(UpdateList, "DependencyClosures",
+                          wraps=UpdateList.DependencyClosures) as mock_cls:
+            updates_list = UpdateList.UpdateList(parent=None, dist='lucid')
+            updates_list.update(self.cache)
+        for (args, kwargs) in mock_cls.call_args_list:
+            self.assertNotIn("ubuntu-minimal",
+                             [pkg.name for pkgs in args[1] for pkg in pkgs])
+        self.assertListEqual(
+            [x.pkg.name for x in updates_list.security_groups[0].items],
+            ['base-pkg'])
+
+    def test_snapshot(self):
+        # update() in setUp saved the snapshot
+        self.cache.clear()
+        updates_list = UpdateList.UpdateList(parent=None, dist='lucid')
+        self.assertTrue(updates_list.load_snapshot(self.cache))
+        self.assertTrue(updates_list.from_snapshot)
+        self.assertEqual(updates_list.get_snapshot(),
+                         self.updates_list.get_snapshot())
+        self.assertListEqual(
+            [(g.name, [x.pkg.name for x in g.items])
+             for g in updates_list.update_groups],
+            [(g.name, [x.pkg.name for x in g.items])
+             for g in self.updates_list.update_groups])
+        self.assertTrue(self.cache["installed-app"].marked_upgrade)
+
+    def test_snapshot_outdated(self):
+        updates_list = UpdateList.UpdateList(parent=None, dist='lucid')
+        with patch.object(updates_list, "_get_snapshot_stamp") as mock_stamp:
+            mock_stamp.return_value = ["something else"]
+            self.assertFalse(updates_list.load_snapshot(self.cache))
+        self.assertFalse(updates_list.from_snapshot)
+        self.assertListEqual(updates_list.update_groups, [])
+
+    def test_as_dict(self):
+        data = self.updates_list.as_dict(self.cache)
+        self.assertEqual(
+            [[item["package"] for item in group["items"]]
+             for group in data["security_groups"]], [['base-pkg']])
+        group = data["update_groups"][0]
+        self.assertEqual(group["icon"], "package")
+        self.assertEqual(group["size"],
+                         sum(item["size"] for item in group["items"]))
+        self.assertEqual(group["download_size"],
+                         sum(item["download_size"]
+                             for item in group["items"]))
+        self.assertEqual(data["download_size"],
+                         self.cache.get_required_download())
+
+    def test_no_save_caches(self):
+        updates_list = UpdateList.UpdateList(parent=None, dist='lucid')
+        updates_list.save_caches = False
+        with patch.object(UpdateList.utils, "save_cache_file") as mock_save:
+            updates_list.update(self.cache)
+        self.assertFalse(mock_save.called)
+        self.assertTrue(updates_list.update_groups)
+
+    def test_no_gi_import(self):
+        # the update list can be calculated on headless machines
+        code = ("import sys; import UpdateManager.Core.UpdateList; "
+                "sys.exit('gi' in sys.modules)")
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(CURDIR))
+        self.assertEqual(subprocess.call([sys.executable, "-c", code],
+                                         env=env), 0)
+
+    def test_changed_packages(self):
+        self.cache.saveDistUpgrade()
+        self.assertListEqual(
+            [pkg.name for pkg in
+             self.updates_list._get_changed_packages(self.cache)],
+            [pkg.name for pkg in self.cache
+             if pkg.is_upgradable or pkg.marked_install])
+
+    def test_download_size(self):
+        archives_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archives_dir)
+        real_archives_dir = apt.apt_pkg.config.find_dir("Dir::Cache::archives")
+        apt.apt_pkg.config.set("Dir::Cache::archives", archives_dir)
+        self.addCleanup(lambda: apt.apt_pkg.config.set(
+            "Dir::Cache::archives", real_archives_dir))
+        pkg = self.cache["installed-app"]
+        size = pkg.candidate.size
+        required_download = self.cache.get_required_download()
+        self.assertEqual(required_download, self.cache._depcache.deb_size)
+        self.assertEqual(self.cache.get_download_size(pkg), size)
+        # the deb was downloaded already
+        deb = "installed-app_%s_all.deb" % pkg.candidate.version
+        with open(os.path.join(archives_dir, deb), "wb") as f:
+            f.write(b"x" * size)
+        self.assertEqual(self.cache.get_download_size(pkg), 0)
+        self.assertEqual(self.cache.get_required_download(),
+                         required_download - size)
+        group = self.updates_list.update_groups[0]
+        self.assertEqual(group.get_download_size(self.cache), 0)
+
     def test_security(self):
         self.assertEqual(len(self.updates_list.security_groups), 1)
         group = self.updates_list.security_groups[0]
@@ -183,6 +533,18 @@ class GroupingTestCase(unittest.TestCase):
         self.assertIsNone(group.core_item)
         self.assertListEqual([x.pkg.name for x in group.items], ['base-pkg'])
 
+    def test_security_archive_configurable(self):
+        # derivatives can use their own security archive
+        self.assertTrue(self.updates_list._is_security_update(
+            self.cache["base-pkg"]))
+        apt.apt_pkg.config.set(
+            UpdateList.UpdateList.SECURITY_ARCHIVE_KEY, "%s-proposed")
+        self.addCleanup(lambda: apt.apt_pkg.config.clear(
+            UpdateList.UpdateList.SECURITY_ARCHIVE_KEY))
+        updates_list = UpdateList.UpdateList(parent=None, dist='lucid')
+        self.assertFalse(updates_list._is_security_update(
+            self.cache["base-pkg"]))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,6 +1,8 @@
 #!/usr/bin/python3
 # -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
 
+import gzip
+import io
 import logging
 import mock
 import sys
@@ -116,6 +118,38 @@ class TestUtils(unittest.TestCase):
         mock_package.return_value = 'ubuntustudio-desktop'
         self.assertEqual(utils.get_ubuntu_flavor_name(), 'Ubuntu Studio')
 
+    def test_lru_cache(self):
+        cache = utils.LRUCache(2)
+        cache["a"] = 1
+        cache["b"] = 2
+        self.assertEqual(cache.get("a"), 1)
+        # "b" is the least recently used one now
+        cache["c"] = 3
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_gzip_stream(self):
+        lines = [("line %d\n" % n).encode("ascii") for n in range(10000)]
+        lines.append(b"no newline at the end")
+        data = io.BytesIO(gzip.compress(b"".join(lines)))
+        stream = utils.GzipStream(data)
+        self.assertEqual(stream.readline(), lines[0])
+        self.assertEqual(stream.read(3), lines[1][:3])
+        self.assertEqual(stream.readline(), lines[1][3:])
+        self.assertEqual(list(iter(stream.readline, b"")), lines[2:])
+        self.assertEqual(stream.read(), b"")
+
+        response = mock.Mock()
+        response.info.return_value = {"Content-Encoding": "gzip"}
+        self.assertIsInstance(utils.decode_response(response),
+                              utils.GzipStream)
+        response.info.return_value = {}
+        self.assertIs(utils.decode_response(response), response)
+
 
 if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1] == "-v":
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+# -*- Mode: Python; indent-tabs-mode: nil; tab-width: 4; coding: utf-8 -*-
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import apt
+from gi.repository import Gio
+from mock import MagicMock, patch
+
+from UpdateManager.Core import UpdateList
+from UpdateManager.Core.MyCache import MyCache
+from UpdateManager.UpdateManager import UpdateManager
+
+CURDIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class TestValidateUpdateList(unittest.TestCase):
+
+    def setUp(self):
+        cache_home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_home)
+        patcher = patch.dict(os.environ, {"XDG_CACHE_HOME": cache_home})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        real_arch = apt.apt_pkg.config.find("APT::Architecture")
+        apt.apt_pkg.config.set("APT::Architecture", "amd64")
+        self.addCleanup(
+            lambda: apt.apt_pkg.config.set("APT::Architecture", real_arch))
+        patcher = patch('gi.repository.Gio.DesktopAppInfo.new_from_filename')
+        patcher.start().side_effect = self.fake_desktop
+        self.addCleanup(patcher.stop)
+
+        self.cache = MyCache(apt.progress.base.OpProgress(),
+                             rootdir=os.path.join(CURDIR,
+                                                  "aptroot-grouping-test"))
+        self.cache.open()
+        # the snapshot of the last run
+        UpdateList.UpdateList(parent=None, dist='lucid').update(self.cache)
+        self.cache.clear()
+        self.snapshot_list = UpdateList.UpdateList(parent=None, dist='lucid')
+        self.assertTrue(self.snapshot_list.load_snapshot(self.cache))
+
+        patcher = patch('UpdateManager.UpdateManager.UpdateManager')
+        self.addCleanup(patcher.stop)
+        self.manager = patcher.start()
+        self.manager._check_meta_release.return_value = False
+        self.manager.hwe_replacement_packages = None
+        self.manager.datadir = os.path.join(CURDIR, '..', 'data')
+        self.manager.cache = self.cache
+
+    def fake_desktop(self, path):
+        app = MagicMock()
+        app.get_filename.return_value = path
+        app.get_display_name.return_value = 'App ' + os.path.basename(path)
+        app.get_icon.return_value = Gio.ThemedIcon.new("package")
+        return app
+
+    def test_validate_keeps_selection(self):
+        pane = UpdateManager._make_available_pane(self.manager, 1)
+        pane.list = self.snapshot_list
+        names = [item.pkg.name for group in self.snapshot_list.update_groups
+                 for item in group.items]
+        self.assertIn("installed-pkg", names)
+        # the user deselected one of the updates before the validation
+        self.cache["installed-pkg"].mark_keep()
+        with patch("UpdateManager.UpdatesAvailable.UpdateList",
+                   lambda parent: UpdateList.UpdateList(parent, dist='lucid')
+                   ), \
+                patch.object(pane, "set_update_list") as set_update_list, \
+                patch.object(pane, "updates_changed"):
+            pane._validate_update_list()
+        self.assertFalse(set_update_list.called)
+        self.assertIsNot(pane.list, self.snapshot_list)
+        self.assertIs(self.manager.update_list, pane.list)
+        for name in names:
+            self.assertEqual(self.cache[name].marked_upgrade,
+                             name != "installed-pkg", name)
+        self.assertTrue(pane.treeview_update.get_sensitive())
+
+    def test_validate_outdated(self):
+        pane = UpdateManager._make_available_pane(self.manager, 1)
+        pane.list = self.snapshot_list
+        newer_list = UpdateList.UpdateList(parent=None, dist='lucid')
+        self.assertTrue(newer_list.load_snapshot(self.cache))
+        names = [item.pkg.name for group in newer_list.update_groups
+                 for item in group.items]
+        states = []
+
+        def set_newer_list():
+            # nothing that changes the marks can be used meanwhile
+            states.append((pane.validating,
+                           pane.treeview_update.get_sensitive(),
+                           pane.button_install.get_sensitive()))
+            pane.list = newer_list
+            self.cache.clear()
+            return 0
+        with patch("UpdateManager.UpdatesAvailable.UpdateList",
+                   lambda parent: UpdateList.UpdateList(parent, dist='lucid')
+                   ), \
+                patch.object(pane, "updates_changed"), \
+                patch.object(pane.cache, "saveDistUpgrade",
+                             side_effect=set_newer_list):
+            pane._validate_update_list()
+        self.assertEqual(states, [(True, False, False)])
+        self.assertFalse(pane.validating)
+        # a list that was set during the validation is not replaced, and
+        # its updates are marked again
+        self.assertIs(pane.list, newer_list)
+        for name in names:
+            self.assertTrue(self.cache[name].marked_upgrade, name)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "-v":
+        logging.basicConfig(level=logging.DEBUG)
+    unittest.main()